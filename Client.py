@@ -1,9 +1,18 @@
+import asyncio
 import socket
 import re
+from collections import deque, namedtuple
 from sys import argv, stderr
+from linebuf import ReplyBuffer
 
 # PORTNUM = 8000 + 4463
 BUFSIZE = 1024
+# AsyncClient defaults, sessions open at once to each server and how many
+# idle connections to one server are kept around for the next message
+ASYNC_MAX_SESSIONS = 16
+POOL_SIZE = 8
+# sessions a DeliveryPlanner has going at once over every destination
+FANOUT_MAX_SESSIONS = 64
 
 # regex for checking correct mailbox format
 mb_regex = r"^[0-9a-zA-z!#$%^&*`~_|?=+/-]+@[a-zA-Z][0-9a-zA-Z]*(?:.[a-zA-Z][0-9a-zA-Z]*)*$"
@@ -19,6 +28,10 @@ DATA = "send data"
 QUIT = "end connection"
 ERR = "error"
 END = "done"
+# not return codes, signal there is another queued message for the same
+# session, or that the message went through and nothing else is queued
+NEXTMSG = "next message"
+MSGSENT = "message sent"
 
 # constants labeling the return codes
 CONNECTEST = '220'
@@ -29,31 +42,77 @@ QUITREC = '221'
 BADCMD = '500'
 BADPARAM = '501'
 BADORDER = '503'
-
+NOTIMPL = '502'
+# what a server that doesn't know EHLO answers it with, the original
+# Server.py gives a 503
+EHLO_REFUSED = (BADCMD, NOTIMPL, BADORDER)
+
+# what became of one message sent by AsyncClient. code is the last reply
+# code, '250' when the message was accepted and '' when the connection
+# failed. state is the step the message got to (MF, RT, ERT or DATA) and
+# text the server's reply or the connection error
+SendResult = namedtuple('SendResult', ['code', 'state', 'text'])
+# what became of one message sent by DeliveryPlanner. groups maps each
+# recipient domain to the SendResult of its session, sent and failed split
+# the recipients by how their group went
+FanoutResult = namedtuple('FanoutResult', ['groups', 'sent', 'failed'])
+
+# pipelining sends MAIL FROM, every RCPT TO and DATA in one go whenever the
+# server's EHLO reply offers PIPELINING, instead of a round trip per command
+# chunking sends the message as a single BDAT chunk in place of DATA when the
+# server offers CHUNKING
+# retry is an outqueue.OutboundQueue, messages that couldn't be sent because
+# the server wasn't there or gave a 4xx (or no) reply go into it instead of
+# being dropped, along with anything queued behind them
 class ClientLoop():
-    def __init__(self, hostname, portnum):
+    def __init__(self, hostname, portnum, pipelining=True, chunking=True, retry=None):
         self.msg_contents = None
+        # msg_contents has been taken by the server with a 250
+        self.accepted = False
+        # further messages to send over the same session once this one is done
+        self.outbox = deque()
+        self.retry = retry
 
         self.hname = hostname
         self.pnum = portnum
         self.servsock = None
+        # replies read off servsock, kept for the whole session
+        self.replies = None
+
+        self.pipelining = pipelining
+        self.chunking = chunking
+        # extension keywords from the server's EHLO reply
+        self.extensions = set()
+        # text of every line of the last reply, continuation lines included
+        self.reply_text = []
 
         # only ref'd to report errors
         self.cstate = ''
         self.rc = ''
+        # the state the last error came up in
+        self.estate = ''
 
         self.transition = {
             (USRIPT, HELO):HELO,
             (HELO, CMDOK):MF,
             (MF, CMDOK):RT,
+            # the whole pipelined group was accepted
+            (MF, DATAPENDING):DATA,
             (RT, CMDOK):ERT,
             (ERT, DATAPENDING):DATA,
-            # TODO does this directly transition into a quit state?
-            (DATA, CMDOK):QUIT,
+            (DATA, NEXTMSG):MF,
+            (DATA, MSGSENT):QUIT,
+            # the message went out as a BDAT chunk, from the pipelined group
+            # or right after the RCPT TOs
+            (MF, NEXTMSG):MF,
+            (MF, MSGSENT):QUIT,
+            (ERT, NEXTMSG):MF,
+            (ERT, MSGSENT):QUIT,
             (QUIT, CONNECTTMN):END,
             # erroneous ack codes recieved
             # handled by keyError exception
             (ERR, QUIT):QUIT,
+            (ERR, END):END,
             # once the end is reached there are
             # no more states to transition into
             (END, END):END
@@ -74,10 +133,25 @@ class ClientLoop():
         # data read from the forwards file, then wait for an
         # ack code
 
+    # adds a message to be sent, everything queued before run goes out over
+    # one connection. msg is a list of body lines each ending in '\n' and
+    # subject should end in '\n' as well, same as typed input
+    def queue(self, sender, recipients, subject, msg):
+        self.outbox.append([
+            sender,
+            recipients,
+            subject,
+            msg
+        ])
+
     def run(self):
         # start the state machine
-        # initial state is expecting user input
-        self.cstate = USRIPT
+        # initial state is expecting user input, unless messages were queued
+        if self.outbox:
+            self.msg_contents = self.outbox.popleft()
+            self.cstate = HELO
+        else:
+            self.cstate = USRIPT
         status = 0
         while status == 0:
             status, self.rc = self.call[self.cstate](self)
@@ -85,6 +159,7 @@ class ClientLoop():
             try:
                 self.cstate = self.transition[(self.cstate, self.rc)]
             except KeyError:
+                self.estate = self.cstate
                 self.cstate = ERR
         
     # TODO quit on eof
@@ -144,16 +219,45 @@ class ClientLoop():
 
         return (0, HELO)
 
+    # a server that doesn't know EHLO takes it as an error and won't accept a
+    # HELO after it either, so falling back to HELO means a QUIT and
+    # connecting again. the QUIT matters, the original Server.py dies on a
+    # client that hangs up without one
     def _send_hello(self):
-        self.servsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        for ehlo in ([True, False] if self.pipelining else [False]):
+            self.servsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # every send is a whole command or piece of the message, holding them
+            # back for Nagle just stalls on the server's delayed ack
+            self.servsock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        try:
-            self.servsock.connect((self.hname, self.pnum))
-        except ConnectionRefusedError:
-            print('Connection to mail server was refused')
-            return (1, '')
+            try:
+                self.servsock.connect((self.hname, self.pnum))
+            except ConnectionRefusedError:
+                print('Connection to mail server was refused')
+                self._defer(True)
+                return (1, '')
+
+            self.replies = ReplyBuffer(BUFSIZE)
+
+            rc = self._get_ack()
+            if rc != '220' or not ehlo:
+                break
+
+            cmd = f'EHLO {socket.gethostname()}\n'
+            self.servsock.send(cmd.encode())
+
+            rc = self._get_ack()
+            # every line after the greeting names one extension
+            if rc == CMDOK:
+                self.extensions = set(ext.split(' ')[0].upper() for ext in self.reply_text[1:])
+                return (0, rc)
+            elif rc not in EHLO_REFUSED:
+                return (0, rc)
+
+            self.servsock.send('QUIT\n'.encode())
+            self._get_ack()
+            self.servsock.close()
 
-        rc = self._get_ack()
         if rc != '220':
             return (0, rc)
 
@@ -162,12 +266,50 @@ class ClientLoop():
 
         return (0, self._get_ack())
 
+    def _use_bdat(self):
+        return self.chunking and 'CHUNKING' in self.extensions
+
     def _send_mailto(self):
+        if self.pipelining and 'PIPELINING' in self.extensions:
+            return self._send_pipelined()
+
         cmd = f'MAIL FROM: <{self.msg_contents[0]}>\n'
         self.servsock.send(cmd.encode())
 
         return (0, self._get_ack())
 
+    # sends MAIL FROM, the RCPT TOs and DATA (or the whole message as a BDAT)
+    # together, then reads back one reply per command in order. the first bad
+    # reply is the one reported
+    def _send_pipelined(self):
+        cmds = [f'MAIL FROM: <{self.msg_contents[0]}>\n']
+        for rcpt in self.msg_contents[1]:
+            cmds.append(f'RCPT TO: <{rcpt}>\n')
+
+        last = self._bdat() if self._use_bdat() else b'DATA\n'
+        self.servsock.sendall(''.join(cmds).encode() + last)
+
+        # every MAIL FROM and RCPT TO reply first, then the DATA or BDAT one
+        err = ''
+        for _ in cmds:
+            ack = self._get_ack()
+            if ack != CMDOK and err == '':
+                err = ack
+
+        ack = self._get_ack()
+        if err == '' and self._use_bdat():
+            return self._finish_msg(ack)
+        elif err == '':
+            return (0, ack)
+
+        # the server took DATA even though something before it failed,
+        # send an empty message so the session is back in step
+        if ack == DATAPENDING:
+            self.servsock.send('.\n'.encode())
+            self._get_ack()
+
+        return (0, err)
+
     def _send_rcptto(self):
         ack = ''
         for rcpt in self.msg_contents[1]:
@@ -181,38 +323,45 @@ class ClientLoop():
         return (0, ack)
 
     # no longer needs to handle extra rcpt tos
-    # just needs to send DATA cmd
+    # just needs to send DATA cmd, or the message itself when chunking
     def _send_ercptto(self):
+        if self._use_bdat():
+            self.servsock.sendall(self._bdat())
+            return self._finish_msg(self._get_ack())
+
         self.servsock.send('DATA\n'.encode())
-        
+
         return (0, self._get_ack())
 
-    def _send_data(self):
-        # send the header of the email
-        msg = f'From: <{self.msg_contents[0]}>\nTo: '
-        self.servsock.send(msg.encode())
+    # the whole message as one LAST chunk, no terminator or dot-stuffing needed
+    def _bdat(self):
+        msg = message_bytes(*self.msg_contents)
 
-        msg = ''
-        for rcpt in self.msg_contents[1]:
-            msg += f'<{rcpt}>'
+        return f'BDAT {len(msg)} LAST\n'.encode() + msg
 
-            self.servsock.send(msg.encode())
-            msg = ', '
-        
+    def _send_data(self):
+        # header, dot-stuffed body and terminator all go out in one sendall
         # subject input is not stripped, so msg_contents[2] should already have one
         # newline at the end, thus only needs one more for the empty line delineating
         # the header from the body of the email
-        msg = f'\nSubject: {self.msg_contents[2]}\n'
-        self.servsock.send(msg.encode())
+        msg = message_bytes(*self.msg_contents, stuffed=True)
+        self.servsock.sendall(msg + '.\n'.encode())
 
-        # send the body of the email
-        for msg in self.msg_contents[3]:
-            self.servsock.send(msg.encode())
+        return self._finish_msg(self._get_ack())
 
-        # end the data transmission
-        self.servsock.send('.\n'.encode())
-        
-        return (0, self._get_ack())
+    def _finish_msg(self, ack):
+        if ack != CMDOK:
+            return (0, ack)
+
+        self.accepted = True
+
+        # keep the session going if there is more to send
+        if self.outbox:
+            self.msg_contents = self.outbox.popleft()
+            self.accepted = False
+            return (0, NEXTMSG)
+
+        return (0, MSGSENT)
     
     def _send_quit(self):
         self.servsock.send('QUIT\n'.encode())
@@ -239,23 +388,434 @@ class ClientLoop():
         
         print(msg)
 
+        # QUIT only goes out once every message has been accepted, so a bad
+        # reply to it leaves nothing to retry and the session is just closed
+        if self.estate == QUIT:
+            return (0, END)
+
+        # a 5xx won't go any better next time, anything else might. a
+        # message the server already took is never queued again
+        self._defer(self.rc[:1] != '5' and not self.accepted)
+
+        # no reply at all means the connection is gone, nothing to QUIT
+        if self.rc == '':
+            return (0, END)
+
         return(0, QUIT)
 
+    # hands whatever this session won't get to send over to the retry queue,
+    # the current message as well when current is set
+    def _defer(self, current):
+        if self.retry is None:
+            return
+
+        deferred = ([self.msg_contents] if current else []) + list(self.outbox)
+        self.outbox.clear()
+        for msg in deferred:
+            self.retry.submit(self.hname, self.pnum, msg)
+
+        if deferred:
+            print(f'Queued {len(deferred)} message(s) to retry later')
+
+    # reads one whole reply, multi-line ones included, off the session's
+    # ReplyBuffer. only the reply code itself is returned, '' for a badly
+    # formed reply or a closed connection
     def _get_ack(self):
-        ack = self.servsock.recv(BUFSIZE).decode()
+        reply = self.replies.reply()
+        while reply is None:
+            if self.replies.fill(self.servsock) == 0:
+                self.reply_text = []
+                return ''
+
+            reply = self.replies.reply()
+
         # delete vestigial printout
         #errprint(ack)
 
-        # recieved ack code must have the correct number
-        # in addition to being a well-formed message
-        # ie must follow <code><whitespace><*+><CRLF>
+        self.reply_text = reply.text
+
+        return reply.code
+
+# the message as it's sent after DATA or BDAT, the From, To and Subject
+# header followed by the body. a body missing its last newline gets one, so
+# the next message in the mailbox starts on its own line
+# stuffed doubles the '.' at the start of any body line, as DATA needs so a
+# line of just '.' isn't taken for the end of the message. the header lines
+# never start with one, so it's done over the whole message in one pass
+def message_bytes(sender, recipients, subject, body, stuffed=False):
+    rcpts = ', '.join(f'<{rcpt}>' for rcpt in recipients)
+    msg = f'From: <{sender}>\nTo: {rcpts}\nSubject: {subject}\n' + ''.join(body)
+    if msg[-1] != '\n':
+        msg += '\n'
+    if stuffed:
+        msg = msg.replace('\n.', '\n..')
+
+    return msg.encode()
+
+# sends messages without any user input, many at once over asyncio
+#
+# every server gets a pool of sessions, at most max_sessions of them busy
+# with a message at one time and at most pool_size left open between
+# messages, so a long run of messages reuses the same few connections. a
+# message is (sender, recipients, subject, body), the same as for
+# ClientLoop.queue, and comes back as a SendResult. a refused message is
+# RSET and its session goes on to the next one
+#
+# the blocking Server.py loop serves one connection at a time and an idle
+# pooled session keeps it busy, so against it max_sessions has to be 1
+#
+#   client = AsyncClient()
+#   results = await client.send_all(host, port, messages)
+#   await client.close()
+class AsyncClient():
+    def __init__(self, max_sessions=ASYNC_MAX_SESSIONS, pool_size=POOL_SIZE, pipelining=True, chunking=True):
+        self.max_sessions = max_sessions
+        self.pool_size = min(pool_size, max_sessions)
+        self.pipelining = pipelining
+        self.chunking = chunking
+
+        # (host, port) -> _SessionPool
+        self.pools = {}
+
+    # rcpt_to, when given, is who the message actually goes to, the
+    # recipients in message are then only what its To: header lists
+    async def send(self, host, port, message, rcpt_to=None):
+        pool = self._pool(host, port)
+
+        try:
+            session = await pool.acquire()
+        except OSError as e:
+            return SendResult('', HELO, str(e))
+
+        if session.failed is not None:
+            pool.release(session)
+            return session.failed
+
+        reuse = False
+        try:
+            result = await session.send(*message, rcpt_to=rcpt_to)
+            reuse = True
+        except OSError as e:
+            result = SendResult('', session.state, str(e))
+        finally:
+            pool.release(session, reuse)
+
+        return result
+
+    # sends every message in messages, up to max_sessions at a time, and
+    # returns their results in the same order. messages is only walked as
+    # fast as sessions free up, so it can be a generator over a huge list
+    async def send_all(self, host, port, messages):
+        results = {}
+        pending = iter(enumerate(messages))
+
+        async def sender():
+            for i, message in pending:
+                results[i] = await self.send(host, port, message)
+
+        await asyncio.gather(*(sender() for _ in range(self.max_sessions)))
+
+        return [results[i] for i in range(len(results))]
+
+    # QUITs every idle session, anything still sending is left to finish
+    async def close(self):
+        for pool in self.pools.values():
+            await pool.close()
+        self.pools = {}
+
+    def _pool(self, host, port):
+        pool = self.pools.get((host, port))
+        if pool is None:
+            pool = _SessionPool(host, port, self)
+            self.pools[(host, port)] = pool
+
+        return pool
+
+# the sessions AsyncClient has with one server
+class _SessionPool():
+    def __init__(self, host, port, client):
+        self.host = host
+        self.port = port
+        self.client = client
+        self.slots = asyncio.Semaphore(client.max_sessions)
+        self.idle = []
+        # sessions on their way out, so close() can wait for their QUIT
+        self.closing = set()
+
+    # waits for a free slot, then hands out an idle session or opens one
+    async def acquire(self):
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop()
+
+        try:
+            session = await self._open(self.client.pipelining)
+            # a server that doesn't know EHLO takes it as an error and won't
+            # accept a HELO after it either, so that goes on a new connection
+            if session.ehlo_refused:
+                await session.quit()
+                session = await self._open(False)
+        except OSError:
+            self.slots.release()
+            raise
+
+        return session
+
+    async def _open(self, ehlo):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+
+        session = _AsyncSession(reader, writer, ehlo, self.client.chunking)
         try:
-            if (ack[3] == ' ' or ack[3] == '\t') and ack[4:-1] != '':
-                # only the error code itself is returned
-                return ack[:3]
-        except IndexError:
+            await session.hello()
+        except OSError:
+            session.abort()
+            raise
+
+        return session
+
+    # a session that ended in the middle of something isn't put back
+    def release(self, session, reuse=False):
+        if reuse and session.failed is None and len(self.idle) < self.client.pool_size:
+            self.idle.append(session)
+        else:
+            task = asyncio.ensure_future(session.quit())
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+        self.slots.release()
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        await asyncio.gather(*(session.quit() for session in idle), *self.closing)
+
+# one connection to the server, driven a message at a time by AsyncClient
+class _AsyncSession():
+    def __init__(self, reader, writer, pipelining, chunking):
+        self.reader = reader
+        self.writer = writer
+        self.replies = ReplyBuffer(BUFSIZE)
+
+        self.pipelining = pipelining
+        self.chunking = chunking
+        self.extensions = set()
+        self.reply_text = []
+
+        # the step the current message got to, for reporting where it failed
+        self.state = HELO
+        # set when the greeting went wrong, the session can't be used
+        self.failed = None
+        # the server doesn't know EHLO, HELO needs a new connection
+        self.ehlo_refused = False
+
+    async def hello(self):
+        rc = await self._get_ack()
+        if rc != CONNECTEST:
+            self.failed = SendResult(rc, HELO, ' '.join(self.reply_text))
+            return
+
+        if self.pipelining:
+            self.writer.write(f'EHLO {socket.gethostname()}\n'.encode())
+            rc = await self._get_ack()
+            if rc == CMDOK:
+                self.extensions = set(ext.split(' ')[0].upper() for ext in self.reply_text[1:])
+                return
+            elif rc in EHLO_REFUSED:
+                self.ehlo_refused = True
+                return
+        else:
+            self.writer.write(f'HELO {socket.gethostname()}\n'.encode())
+            rc = await self._get_ack()
+
+        if rc != CMDOK:
+            self.failed = SendResult(rc, HELO, ' '.join(self.reply_text))
+
+    # same commands as ClientLoop, pipelined and with BDAT when offered
+    async def send(self, sender, recipients, subject, body, rcpt_to=None):
+        bdat = self.chunking and 'CHUNKING' in self.extensions
+        msg = message_bytes(sender, recipients, subject, body, stuffed=not bdat)
+
+        cmds = [f'MAIL FROM: <{sender}>\n'.encode()]
+        states = [MF]
+        for rcpt in recipients if rcpt_to is None else rcpt_to:
+            cmds.append(f'RCPT TO: <{rcpt}>\n'.encode())
+            states.append(RT)
+        cmds.append(f'BDAT {len(msg)} LAST\n'.encode() + msg if bdat else b'DATA\n')
+        states.append(ERT)
+        expected = [CMDOK] * (len(cmds) - 1) + [CMDOK if bdat else DATAPENDING]
+
+        # every reply is read even after a failure, so the session stays in step
+        replies = []
+        if self.pipelining and 'PIPELINING' in self.extensions:
+            self.state = MF
+            self.writer.write(b''.join(cmds))
+            for _ in cmds:
+                replies.append((await self._get_ack(), ' '.join(self.reply_text)))
+        else:
+            for state, cmd, want in zip(states, cmds, expected):
+                self.state = state
+                self.writer.write(cmd)
+                replies.append((await self._get_ack(), ' '.join(self.reply_text)))
+                if replies[-1][0] != want:
+                    break
+
+        for state, (code, text), want in zip(states, replies, expected):
+            if code != want:
+                return await self._refused(SendResult(code, state, text), replies[-1][0])
+
+        if not bdat:
+            self.state = DATA
+            self.writer.write(msg + b'.\n')
+            code = await self._get_ack()
+            if code != CMDOK:
+                return await self._refused(SendResult(code, DATA, ' '.join(self.reply_text)), code)
+
+        return SendResult(CMDOK, self.state, ' '.join(self.reply_text))
+
+    async def quit(self):
+        try:
+            if self.failed is None:
+                self.writer.write('QUIT\n'.encode())
+                await self._get_ack()
+        except OSError:
             pass
-        return ''
+        finally:
+            self.abort()
+
+    def abort(self):
+        self.writer.close()
+
+    # puts the session back to where a new message can start
+    async def _refused(self, result, last):
+        # the server took DATA even though something before it failed
+        if last == DATAPENDING:
+            self.writer.write('.\n'.encode())
+            await self._get_ack()
+        self.writer.write('RSET\n'.encode())
+        await self._get_ack()
+
+        return result
+
+    # one whole reply, multi-line ones included, as in ClientLoop._get_ack
+    async def _get_ack(self):
+        await self.writer.drain()
+
+        reply = self.replies.reply()
+        while reply is None:
+            data = await self.reader.read(BUFSIZE)
+            if data == b'':
+                raise ConnectionError('server closed the connection')
+
+            self.replies.feed(data)
+            reply = self.replies.reply()
+
+        self.reply_text = reply.text
+
+        return reply.code
+
+# the part of a mailbox after the '@', the same split the server makes to
+# pick the forward file
+def recipient_domain(rcpt):
+    return rcpt[rcpt.find('@')+1:]
+
+# a stand-in resolver for DeliveryPlanner, looks each domain up in hosts
+# (domain -> (host, port)) and sends everything else to default
+def host_map(hosts, default=None):
+    return lambda domain: hosts.get(domain, default)
+
+# fans each message out to the servers of its recipients' domains
+#
+# a message's recipients are grouped by domain and every group gets its own
+# session, carrying the same message with only that group's RCPT TOs.
+# resolve(domain) names the (host, port) taking mail for a domain, or None
+# when there's nowhere to send it
+#
+# each destination has its own workers, at most max_sessions_per_host of
+# them, and all of them share max_sessions slots, held only while a message
+# is actually being sent. a destination that's slow to answer only ties up
+# its own workers and the rest keep going
+class DeliveryPlanner():
+    def __init__(self, resolve, max_sessions=FANOUT_MAX_SESSIONS, max_sessions_per_host=ASYNC_MAX_SESSIONS,
+                 pool_size=POOL_SIZE, pipelining=True, chunking=True):
+        self.resolve = resolve
+        self.max_sessions = max_sessions
+        self.client = AsyncClient(min(max_sessions_per_host, max_sessions), pool_size, pipelining, chunking)
+
+    # returns the recipients of one message grouped by domain, in the order
+    # each domain first turns up
+    def plan(self, recipients):
+        groups = {}
+        for rcpt in recipients:
+            groups.setdefault(recipient_domain(rcpt), []).append(rcpt)
+
+        return groups
+
+    async def deliver(self, message):
+        return (await self.deliver_all([message]))[0]
+
+    # fans out every message, returns a FanoutResult per message in order
+    async def deliver_all(self, messages):
+        messages = list(messages)
+        slots = asyncio.Semaphore(self.max_sessions)
+        groups = [{} for _ in messages]
+
+        # (host, port) -> every (message, domain, recipients) bound there
+        jobs = {}
+        for i, message in enumerate(messages):
+            for domain, rcpts in self.plan(message[1]).items():
+                dest = self.resolve(domain)
+                if dest is None:
+                    groups[i][domain] = SendResult('', HELO, f'no server known for {domain}')
+                else:
+                    jobs.setdefault(dest, deque()).append((i, domain, rcpts))
+
+        async def worker(dest, queue):
+            while queue:
+                i, domain, rcpts = queue.popleft()
+                async with slots:
+                    groups[i][domain] = await self.client.send(*dest, messages[i], rcpt_to=rcpts)
+
+        await asyncio.gather(*(worker(dest, queue)
+                               for dest, queue in jobs.items()
+                               for _ in range(min(self.client.max_sessions, len(queue)))))
+
+        return [self._result(message, result) for message, result in zip(messages, groups)]
+
+    async def close(self):
+        await self.client.close()
+
+    def _result(self, message, groups):
+        sent = []
+        failed = []
+        for rcpt in message[1]:
+            if groups[recipient_domain(rcpt)].code == CMDOK:
+                sent.append(rcpt)
+            else:
+                failed.append(rcpt)
+
+        return FanoutResult(groups, sent, failed)
+
+# fans messages out with a DeliveryPlanner from blocking code
+# returns one FanoutResult per message, in order
+def fan_out(messages, resolve, max_sessions=FANOUT_MAX_SESSIONS, max_sessions_per_host=ASYNC_MAX_SESSIONS):
+    async def send():
+        planner = DeliveryPlanner(resolve, max_sessions, max_sessions_per_host)
+        try:
+            return await planner.deliver_all(messages)
+        finally:
+            await planner.close()
+
+    return asyncio.run(send())
+
+# sends messages with an AsyncClient from blocking code
+# returns one SendResult per message, in order
+def send_messages(host, port, messages, max_sessions=ASYNC_MAX_SESSIONS, pool_size=POOL_SIZE):
+    async def send():
+        client = AsyncClient(max_sessions, pool_size)
+        try:
+            return await client.send_all(host, port, messages)
+        finally:
+            await client.close()
+
+    return asyncio.run(send())
 
 def errprint(line):
     # get rid of the '\n' at the end of a line of user input
@@ -269,6 +829,15 @@ if __name__ == "__main__":
         serv_hostname = argv[1]
         serv_portnum = int(argv[2])
 
-        cli = ClientLoop(serv_hostname, serv_portnum)
+        # Client.py <host> <port> retry keeps a message that couldn't be sent
+        # in outqueue/, python outqueue.py outqueue run sends it later
+        retry = None
+        if len(argv) > 3 and argv[3] == 'retry':
+            from outqueue import OutboundQueue
+            retry = OutboundQueue()
+
+        cli = ClientLoop(serv_hostname, serv_portnum, retry=retry)
 
-        cli.run()
\ No newline at end of file
+        cli.run()
+        if retry is not None:
+            retry.close()
\ No newline at end of file
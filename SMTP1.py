@@ -2,12 +2,16 @@
 # onyen: erzh
 # PID: 730294463
 
+from sys import argv
 from parse import CMDParser
+from mailstore import Spool, FlatStore, STORES, MAX_MSG_SIZE, valid_name
 
 class ServerLoop():
-    def __init__(self, input_stream):
+    def __init__(self, input_stream, max_size=MAX_MSG_SIZE, store=None):
         self.parser = CMDParser()
         self.cmdinput = input_stream
+        self.max_size = max_size
+        self.store = FlatStore() if store is None else store
         self.fpath = []
         self.buffer = []
 
@@ -24,16 +28,16 @@ class ServerLoop():
         cmd = self.cmdinput.readline()
         
         self._echo(cmd)
-        self.parser.parse(cmd)
+        result = self.parser.parse(cmd)
 
-        if self.parser.status == 0 and self.parser.cmd == 0:
-            self.buffer.append(f'From: <{self._get_path(cmd)}>\n')
+        if result.status == 0 and result.cmd == 0:
+            self.buffer.append(f'From: <{result.path}>\n')
             print('250 OK')
             self._expect_rcpt()
         else:
-            if self.parser.bad_token[-3:] == 'cmd':
+            if result.bad_token[-3:] == 'cmd':
                 print('500 Syntax error: command unrecognized')
-            elif self.parser.cmd != 0:
+            elif result.cmd != 0:
                 print("503 Bad sequence of commands")
             else:
                 print('501 Syntax error in parameters or arguments')
@@ -44,27 +48,33 @@ class ServerLoop():
         cmd = self.cmdinput.readline()
 
         self._echo(cmd)
-        self.parser.parse(cmd)
+        result = self.parser.parse(cmd)
 
-        if self.parser.status == 0 and self.parser.cmd == 1:
-            self.buffer.append(f'To: <{self._get_path(cmd)}>\n')
-            self.fpath.append(self._get_path(cmd))
+        if result.status == 0 and result.cmd == 1 and not valid_name(result.path):
+            print('553 Requested action not taken: mailbox name not allowed')
+            return
+        elif result.status == 0 and result.cmd == 1:
+            self.buffer.append(f'To: <{result.path}>\n')
+            self.fpath.append(result.path)
             print('250 OK')
 
             # check for more recipients following the first
-            while(self.parser.status == 0):
+            while(result.status == 0):
                 cmd = self.cmdinput.readline()
 
                 self._echo(cmd)
-                self.parser.parse(cmd)
+                result = self.parser.parse(cmd)
 
-                if self.parser.status == 0:
-                    if self.parser.cmd == 1:
-                        self.buffer.append(f'To: <{self._get_path(cmd)}>\n')
-                        self.fpath.append(self._get_path(cmd))
+                if result.status == 0:
+                    if result.cmd == 1 and not valid_name(result.path):
+                        print('553 Requested action not taken: mailbox name not allowed')
+                        return
+                    elif result.cmd == 1:
+                        self.buffer.append(f'To: <{result.path}>\n')
+                        self.fpath.append(result.path)
                         print('250 OK')
                     # when the rcpt parse fails, check for data
-                    elif self.parser.cmd == 2:
+                    elif result.cmd == 2:
                         # print intermediate response
                         print('354 Start mail input; end with <CRLF>.<CRLF>')
                         self._expect_data()
@@ -74,41 +84,42 @@ class ServerLoop():
                         print("503 Bad sequence of commands")
                         return
 
-        if self.parser.bad_token[-3:] == 'cmd':
+        if result.bad_token[-3:] == 'cmd':
             print('500 Syntax error: command unrecognized')
-        elif self.parser.cmd >= 0:
+        elif result.cmd >= 0:
             print("503 Bad sequence of commands")
         else:
             print('501 Syntax error in parameters or arguments')
     
     # used for parsing the data of the email itself and not the data cmd
+    # the From/To lines collected so far go into the spool first and the
+    # body is streamed in after them
     def _expect_data(self):
         acc = False
+        spool = Spool(self.max_size)
+        spool.write(''.join(self.buffer).encode())
+
         for text in self.cmdinput:
             self._echo(text)
             if text == '.\n':
                 acc = True
                 break
             else:
-                self.buffer.append(text)
-        
+                spool.write(text.encode())
+
         if(acc is True):
-            print('250 OK')
+            if spool.overflow:
+                print(f'552 Message size exceeds fixed maximum message size of {self.max_size} bytes')
+            else:
+                print('250 OK')
 
-            for path in self.fpath:
                 # open or create a file for each path specified in RCPT TO
-                with open(f'forward/{path}', "a") as fout:
-                    fout.writelines(self.buffer)
+                self.store.deliver(spool, self.fpath)
+            spool.close()
         else:
+            spool.close()
             exit(0)
 
-    # takes a syntactically valid command and extracts the path
-    def _get_path(self, cmd):
-        return cmd[cmd.find('<')+1:cmd.find('>')]
-
-    def _get_domain(self, cmd):
-        return cmd[cmd.find('@')+1:]
-    
     def _echo(self, line):
         if line != "":
             print(line[:-1] if line[-1] == '\n' else line)
@@ -117,6 +128,9 @@ class ServerLoop():
             exit(0)
 
 if __name__ == "__main__":
+    # SMTP1.py [flat|sharded|segments|blobs]
+    store = STORES[argv[1]]() if len(argv) > 1 else FlatStore()
+
     with open(0) as stdin:
-        cli = ServerLoop(stdin)
+        cli = ServerLoop(stdin, store=store)
         cli.run()
\ No newline at end of file
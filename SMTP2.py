@@ -1,4 +1,30 @@
+# replays a forward file as SMTP commands on stdout, reading the acks for
+# them from stdin and echoing every ack to stderr
+# usage: python SMTP2.py <forward file> [stream] [stats]
+#   stream reads the forward file in large blocks and buffers all output,
+#   only flushing when the next ack isn't already waiting on stdin. what gets
+#   written is the same either way, byte for byte
+#   stats (stream only) reports throughput on stderr once the replay is done
+#
+# usage: python SMTP2.py <forward file> parallel <host> <port> [workers]
+#   sends the forward file straight to Server.py over several connections at
+#   once, see parallel_replay. the server should be the async one, the
+#   blocking loop only takes one connection at a time
+
+import codecs
+import io
+import locale
+import mmap
+import os
+import socket
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from sys import argv, stderr
+from linebuf import ReplyBuffer
 
 MF = "mail from"
 RT = "rcpt to"
@@ -14,6 +40,19 @@ QUITREC = '221'
 BADCMD = '500'
 BADPARAM = '501'
 BADORDER = '503'
+NOTIMPL = '502'
+# what a server that doesn't know EHLO answers it with, the original
+# Server.py gives a 503
+EHLO_REFUSED = (BADCMD, NOTIMPL, BADORDER)
+
+# block size for reading the forward file and stdin in stream mode
+READ_BUFFER = 1 << 20
+# how much output stream mode holds before it has to write it out
+WRITE_BUFFER = 1 << 20
+# a message starts at every line beginning with 'From:', as in _send_data
+BOUNDARY = b'\nFrom:'
+# how many bytes of replies a parallel worker reads at a time
+REPLY_BUFFER = 1 << 16
 
 class ClientLoop():
     def __init__(self, forwardfile, inputstream):
@@ -75,7 +114,7 @@ class ClientLoop():
             self._advance_read()
 
         if self.cline[:5] == 'From:':
-            print('MAIL FROM:' + self.cline[5:], end='')
+            self._write('MAIL FROM:' + self.cline[5:])
 
             return (0, self._get_ack())
         return (1, '')
@@ -86,7 +125,7 @@ class ClientLoop():
         self._advance_read()
 
         if self.cline[:3] == 'To:':
-            print('RCPT TO:'+ self.cline[3:], end='')
+            self._write('RCPT TO:'+ self.cline[3:])
 
             return (0, self._get_ack())
         return (1, '')
@@ -95,9 +134,9 @@ class ClientLoop():
         self._advance_read()
         got_rcpt = True
         if self.cline[:3] == 'To:':
-            print('RCPT TO:'+ self.cline[3:], end='')
+            self._write('RCPT TO:'+ self.cline[3:])
         else:
-            print('DATA')
+            self._write('DATA\n')
             got_rcpt = False
         
         ack = self._get_ack()
@@ -118,11 +157,11 @@ class ClientLoop():
             if self.cline[:5] == "From:":
                 finished = False
                 break
-            print(self.cline, end='')
+            self._write(self.cline)
             
             self._advance_read()
 
-        print('.')
+        self._write('.\n')
         # if the while loop is exitted with ''
         # then EOF has been encountered
         if finished:
@@ -131,17 +170,20 @@ class ClientLoop():
         return (0, self._get_ack())
     
     def _send_quit(self):
-        print('QUIT')
+        self._write('QUIT\n')
 
         return (1, END)
     
+    def _write(self, line):
+        print(line, end='')
+
     # read in the next input line
     def _advance_read(self):
         self.cline = self.ff.readline()
 
     def _get_ack(self):
         ack = self.input.readline()
-        errprint(ack)
+        self._echo(ack)
 
         # recieved ack code must have the correct number
         # in addition to being a well-formed message
@@ -153,6 +195,327 @@ class ClientLoop():
             pass
         return ''
 
+    def _echo(self, ack):
+        errprint(ack)
+
+# ClientLoop with all of its output held in large buffers. every line it
+# sends still depends on the ack before it, so nothing is sent ahead of the
+# acks, but when the acks are already sitting on stdin (a replay against a
+# recorded session) they're read straight out of the input buffer and the
+# whole run goes out in a handful of writes. output is only flushed when an
+# ack has to be waited for, so a live peer on the other end still gets every
+# command before it's expected to answer
+class StreamLoop(ClientLoop):
+    def __init__(self, forwardfile, inputfd):
+        super().__init__(forwardfile, AckReader(inputfd, self._flush_out))
+        # same encodings as print() would use
+        self.out = open(1, 'w', encoding=sys.stdout.encoding, errors=sys.stdout.errors,
+                        buffering=WRITE_BUFFER, closefd=False)
+        self.err = open(2, 'w', encoding=sys.stderr.encoding, errors=sys.stderr.errors,
+                        buffering=WRITE_BUFFER, closefd=False)
+        self.call[MF] = StreamLoop._send_mailto
+
+        self.messages = 0
+        self.lines = 0
+        self.chars = 0
+        self.elapsed = 0
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            super().run()
+        finally:
+            self._flush()
+        self.elapsed = time.perf_counter() - start
+
+    def report(self):
+        elapsed = max(self.elapsed, 1e-9)
+        print(f'replayed {self.messages} messages, {self.lines} lines, {self.chars} chars '
+              f'in {self.elapsed:.3f}s ({self.messages / elapsed:.0f} msgs/sec, '
+              f'{self.chars / elapsed / (1 << 20):.1f} MB/s)', file=stderr)
+
+    def _send_mailto(self):
+        status, ack = super()._send_mailto()
+        if status == 0:
+            self.messages += 1
+
+        return (status, ack)
+
+    def _write(self, line):
+        self.out.write(line)
+        self.lines += 1
+        self.chars += len(line)
+
+    def _echo(self, ack):
+        self.err.write(ack[:-1] + '\n')
+
+    # the peer only needs the commands, the echoed acks can wait until the end
+    def _flush_out(self):
+        self.out.flush()
+
+    def _flush(self):
+        self.out.flush()
+        self.err.flush()
+
+# reads acks off a file descriptor a block at a time, decoding them the same
+# way open(0) would (locale encoding, universal newlines). calls before_block
+# whenever it has no full line buffered and has to wait on the descriptor
+class AckReader():
+    def __init__(self, fd, before_block):
+        self.fd = fd
+        self.before_block = before_block
+        decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))()
+        self.decoder = io.IncrementalNewlineDecoder(decoder, True)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def readline(self):
+        while True:
+            end = self.buf.find('\n', self.pos)
+            if end != -1:
+                line = self.buf[self.pos:end + 1]
+                self.pos = end + 1
+                return line
+
+            if self.eof:
+                line = self.buf[self.pos:]
+                self.buf = ''
+                self.pos = 0
+                return line
+
+            self.before_block()
+            data = os.read(self.fd, READ_BUFFER)
+            self.eof = data == b''
+            self.buf = self.buf[self.pos:] + self.decoder.decode(data, self.eof)
+            self.pos = 0
+
+# offsets of every message in a forward file, the first line and every
+# 'From:' line after it, found with one find pass over the mapped file
+def index_messages(path):
+    offsets = array('Q')
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return offsets, size
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            while pos != -1:
+                offsets.append(pos)
+                pos = mm.find(BOUNDARY, pos)
+                if pos != -1:
+                    pos += 1
+
+    return offsets, size
+
+# splits the indexed messages into at most n runs of whole messages with
+# about the same number of bytes each, as (start, end) byte ranges
+def split_ranges(offsets, size, n):
+    if len(offsets) == 0:
+        return []
+
+    cuts = [0]
+    for k in range(1, n):
+        i = bisect_left(offsets, size * k // n)
+        if i < len(offsets) and offsets[i] > cuts[-1]:
+            cuts.append(offsets[i])
+    cuts.append(size)
+
+    return list(zip(cuts[:-1], cuts[1:]))
+
+# turns one message into what ClientLoop would send for it, its MAIL FROM
+# and RCPT TO commands and its DATA payload through the '.' line. None when
+# the line after From: isn't a To:, where ClientLoop gives up. Server.py
+# takes a leading '.' back off body lines, so they're dot-stuffed here
+def message_commands(msg):
+    lines = io.BytesIO(msg).readlines()
+    if len(lines) < 2 or lines[1][:3] != b'To:':
+        return None
+
+    cmds = [b'MAIL FROM:' + lines[0][5:]]
+    i = 1
+    while i < len(lines) and lines[i][:3] == b'To:':
+        cmds.append(b'RCPT TO:' + lines[i][3:])
+        i += 1
+
+    # a last line missing its newline would swallow the '.', leaving the
+    # server waiting for the end of the message
+    if i < len(lines) and lines[-1][-1:] != b'\n':
+        lines[-1] += b'\n'
+
+    data = b''.join(lines[i:])
+    if data[:1] == b'.':
+        data = b'.' + data
+
+    return cmds, data.replace(b'\n.', b'\n..') + b'.\n'
+
+# replays the messages in [start, end) of a forward file over one session
+# with the server. a message that gets refused is counted and the session
+# RSET so the rest still go through. returns the counts for report()
+def replay_range(path, host, port, start, end):
+    result = {
+        'messages':0,
+        'sent':0,
+        'refused':0,
+        'malformed':0,
+        'bytes':0,
+        'codes':Counter(),
+        'elapsed':0
+    }
+    began = time.perf_counter()
+
+    sock, replies, pipelining = _open_session(host, port)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, sock:
+        pos = start
+        while pos < end:
+            nxt = mm.find(BOUNDARY, pos, end)
+            nxt = end if nxt == -1 else nxt + 1
+
+            result['messages'] += 1
+            result['bytes'] += nxt - pos
+            parsed = message_commands(mm[pos:nxt])
+            pos = nxt
+
+            if parsed is None:
+                result['malformed'] += 1
+                continue
+
+            code = _replay_message(sock, replies, parsed, pipelining)
+            if code == CMDOK:
+                result['sent'] += 1
+            else:
+                result['refused'] += 1
+                result['codes'][code] += 1
+
+        sock.sendall(b'QUIT\n')
+        _read_reply(sock, replies)
+
+    result['elapsed'] = time.perf_counter() - began
+
+    return result
+
+# connects and greets the server, returns the socket, its ReplyBuffer and
+# whether the server offers PIPELINING. a server that doesn't know EHLO takes
+# it as an error and won't accept a HELO after it either, so HELO is sent
+# over a second connection, after a QUIT on the first
+def _open_session(host, port):
+    for cmd in ('EHLO', 'HELO'):
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        replies = ReplyBuffer(REPLY_BUFFER)
+
+        try:
+            _read_reply(sock, replies)
+            sock.sendall(f'{cmd} {socket.gethostname()}\n'.encode())
+            code, text = _read_reply(sock, replies)
+        except OSError:
+            sock.close()
+            raise
+
+        if code not in EHLO_REFUSED or cmd == 'HELO':
+            break
+
+        try:
+            sock.sendall(b'QUIT\n')
+            _read_reply(sock, replies)
+        finally:
+            sock.close()
+
+    pipelining = code == CMDOK and 'PIPELINING' in (line.split(' ')[0].upper() for line in text[1:])
+
+    return sock, replies, pipelining
+
+# sends one message, returns '250' once it's accepted or the first bad code
+def _replay_message(sock, replies, parsed, pipelining):
+    cmds, data = parsed
+    cmds = cmds + [b'DATA\n']
+
+    # with PIPELINING every command goes in one write and the replies are
+    # read back after, otherwise it's one round trip each
+    if pipelining:
+        sock.sendall(b''.join(cmds))
+        codes = [_read_reply(sock, replies)[0] for _ in cmds]
+    else:
+        codes = []
+        for cmd in cmds:
+            sock.sendall(cmd)
+            codes.append(_read_reply(sock, replies)[0])
+            if codes[-1] != CMDOK:
+                break
+
+    expected = [CMDOK] * (len(cmds) - 1) + [DATAPENDING]
+    err = next((code for code, want in zip(codes, expected) if code != want), None)
+
+    if err is None:
+        sock.sendall(data)
+        return _read_reply(sock, replies)[0]
+
+    # the server may have taken DATA even though something before it failed,
+    # an empty message gets it back out of the data state before the RSET
+    if codes[-1] == DATAPENDING:
+        sock.sendall(b'.\n')
+        _read_reply(sock, replies)
+    sock.sendall(b'RSET\n')
+    _read_reply(sock, replies)
+
+    return err
+
+# reads one whole reply, returns its code and the text of every line
+def _read_reply(sock, replies):
+    reply = replies.reply()
+    while reply is None:
+        if replies.fill(sock) == 0:
+            raise ConnectionError('server closed the connection')
+        reply = replies.reply()
+
+    return reply
+
+# indexes a forward file and replays it to the server at host:port from
+# several processes, each with its own connection and its own run of
+# messages. messages within a run keep their order but the runs go in
+# parallel, so the order they land in a mailbox can change
+def parallel_replay(path, host, port, workers=None):
+    workers = os.cpu_count() if workers is None else workers
+
+    began = time.perf_counter()
+    offsets, size = index_messages(path)
+    ranges = split_ranges(offsets, size, workers)
+
+    with ProcessPoolExecutor(max(1, len(ranges))) as pool:
+        futures = [pool.submit(replay_range, path, host, port, start, end) for start, end in ranges]
+        results = [future.result() for future in futures]
+
+    return merge_results(results, time.perf_counter() - began)
+
+def merge_results(results, elapsed):
+    total = {
+        'workers':len(results),
+        'messages':0,
+        'sent':0,
+        'refused':0,
+        'malformed':0,
+        'bytes':0,
+        'codes':Counter(),
+        'elapsed':elapsed,
+        'slowest':max((r['elapsed'] for r in results), default=0)
+    }
+    for r in results:
+        for key in ('messages', 'sent', 'refused', 'malformed', 'bytes'):
+            total[key] += r[key]
+        total['codes'] += r['codes']
+
+    return total
+
+def report(total):
+    elapsed = max(total['elapsed'], 1e-9)
+    print(f"{total['workers']} workers replayed {total['messages']} messages "
+          f"({total['sent']} sent, {total['refused']} refused, {total['malformed']} malformed) "
+          f"in {total['elapsed']:.3f}s, slowest worker {total['slowest']:.3f}s")
+    print(f"{total['messages'] / elapsed:.0f} msgs/sec, {total['bytes'] / elapsed / (1 << 20):.1f} MB/s")
+    for code, count in sorted(total['codes'].items()):
+        print(f'  {code}: {count}')
+
 def errprint(line):
     # get rid of the '\n' at the end of a line of user input
     print(line[:-1], file=stderr)
@@ -164,11 +527,24 @@ if __name__ == "__main__":
     else:
         forward_file = argv[1]
 
+    stream = 'stream' in argv[2:]
+
     try:
-        with open(forward_file, 'r') as ff, open(0) as stdin:
-            cli = ClientLoop(ff, stdin)
+        if len(argv) > 4 and argv[2] == 'parallel':
+            workers = int(argv[5]) if len(argv) > 5 else None
+            report(parallel_replay(forward_file, argv[3], int(argv[4]), workers))
+        elif stream:
+            with open(forward_file, 'r', buffering=READ_BUFFER) as ff:
+                cli = StreamLoop(ff, 0)
+
+                cli.run()
+                if 'stats' in argv[2:]:
+                    cli.report()
+        else:
+            with open(forward_file, 'r') as ff, open(0) as stdin:
+                cli = ClientLoop(ff, stdin)
 
-            cli.run()
+                cli.run()
     except FileNotFoundError:
         # file name arg does not refer to a findable file
         exit(2)
\ No newline at end of file
@@ -2,9 +2,13 @@
 # onyen: erzh
 # PID: 730294463
 
+import asyncio
+import signal
 import socket
 from sys import argv
-from parse import CMDParser
+from parse import CMDParser, PathCache, PATH_CACHE_SIZE
+from linebuf import LineBuffer
+from mailstore import Spool, FlatStore, DeliveryQueue, STORES, MAX_MSG_SIZE, valid_name
 
 
 # constant port number
@@ -12,36 +16,74 @@ from parse import CMDParser
 MAX_CONNECTION_REQS = 1
 BUFSIZE = 1024
 
+# defaults for the asyncio server mode
+# backlog is handed to listen(), max sessions caps the number of
+# connections being served at once, anything past it gets a 421
+ASYNC_BACKLOG = 128
+ASYNC_MAX_SESSIONS = 1024
+
+# ESMTP extensions advertised in the EHLO reply
+EXTENSIONS = ['PIPELINING', 'CHUNKING']
+
 # constants labeling states
-WAIT = "waiting" # for a connection
+WAIT = "waiting" # for a HELO on a fresh connection
 MF = "mail from"
 RT = "rcpt to"
 ERT = "extra rcpt to"
 DATA = "data"
 QUIT = "disconnect"
 ERR = "error"
+CHUNK = "bdat chunk" # raw message bytes following a BDAT
+BDAT = "bdat" # between chunks, waiting on the next BDAT
+
+# not reply codes, label a transaction being thrown away by RSET, and an
+# RSET from a client that hasn't greeted successfully yet
+RSETOK = "reset"
+RSETNOHELO = "reset before helo"
+# also not reply codes, a BDAT was accepted and its chunk should be read next,
+# and a chunk that wasn't the LAST one has been read in full
+CHUNKPENDING = "chunk pending"
+CHUNKOK = "chunk received"
 
 # constants for response codes
 CONNECTEST = '220'
 CONNECTTMN = '221'
+SVCUNAVAIL = '421'
 CMDOK = '250'
 DATAPENDING = '354'
+TOOBIG = '552'
 BADCMD = '500'
 BADPARAM = '501'
 BADORDER = '503'
-
-class ServerLoop():
-    def __init__(self, port_num):
-        self.parser = CMDParser()
+BADMAILBOX = '553'
+LOCALERR = '451'
+
+# holds the SMTP state machine for a single connection
+# the session never touches a socket itself, commands are fed in and the
+# replies it produces are queued up in self.replies for whichever loop
+# owns the connection to send out
+class Session():
+    def __init__(self, parser=None, max_size=MAX_MSG_SIZE, store=None):
+        self.parser = CMDParser() if parser is None else parser
+        # where accepted messages are delivered to
+        self.store = FlatStore() if store is None else store
 
         self.fpath = set()
-        self.buffer = []
-        self.rcode = ''
-
-        self.sock = None
-        self.pnum = port_num
-        self.csock = None
-        self.addr = None
+        self.spool = None
+        self.max_size = max_size
+        self.replies = []
+        # the last line fed in was only the first part of an overlong one
+        self.partial = False
+
+        # bytes of the current BDAT chunk still to come, whether it is the
+        # LAST one, and the reply to give once a refused chunk is read past
+        self.chunk_left = 0
+        self.chunk_last = False
+        self.chunk_err = ''
+
+        self.cstate = WAIT
+        self.helo = '' # domain the client greeted with
+        self.done = False
 
         self.transition = {
             (WAIT, CMDOK):MF,
@@ -49,62 +91,144 @@ class ServerLoop():
             (RT, CMDOK):ERT,
             (ERT, CMDOK):ERT,
             (ERT, DATAPENDING):DATA,
-            (DATA, CMDOK):QUIT,
-            (QUIT, CONNECTTMN):WAIT
+            # the session stays open for more transactions after a message
+            (DATA, CMDOK):MF,
+            (DATA, TOOBIG):MF,
+            (MF, CONNECTTMN):WAIT,
+            (QUIT, CONNECTTMN):WAIT,
+            # RSET throws away the transaction in progress
+            (WAIT, RSETNOHELO):WAIT,
+            (QUIT, RSETNOHELO):WAIT,
+            (MF, RSETOK):MF,
+            (RT, RSETOK):MF,
+            (ERT, RSETOK):MF,
+            (QUIT, RSETOK):MF,
+            (BDAT, RSETOK):MF,
+            # a chunk always gets read, even for a BDAT that is refused
+            (WAIT, CHUNKPENDING):CHUNK,
+            (MF, CHUNKPENDING):CHUNK,
+            (RT, CHUNKPENDING):CHUNK,
+            (ERT, CHUNKPENDING):CHUNK,
+            (BDAT, CHUNKPENDING):CHUNK,
+            (QUIT, CHUNKPENDING):CHUNK,
+            (CHUNK, CHUNKOK):BDAT,
+            (CHUNK, CMDOK):MF,
+            (CHUNK, TOOBIG):MF
             # erroneous input recieved
             # ( / ), will be caught as exception
         }
 
         self.call = {
-            WAIT:ServerLoop._waitfor_connection,
-            MF:ServerLoop._expect_mailf,
-            RT:ServerLoop._expect_rcpt,
-            ERT:ServerLoop._expect_ercpt,
-            DATA:ServerLoop._expect_data,
-            QUIT:ServerLoop._expect_quit
+            WAIT:Session._expect_helo,
+            MF:Session._expect_mailf,
+            RT:Session._expect_rcpt,
+            ERT:Session._expect_ercpt,
+            DATA:Session._expect_data,
+            BDAT:Session._expect_bdat,
+            QUIT:Session._expect_quit
         }
 
-    def run(self):
-        # creates a socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.sock.bind(('', self.pnum))
-            self.sock.listen(MAX_CONNECTION_REQS)
-        except OSError:
-            print('Server socket establishment failed, perhaps the port number is already in use')
-            return
+    # queues the greeting sent as soon as a connection is accepted
+    def start(self):
+        self._so_sock('220 ' + socket.gethostname())
 
-        # starts the state machine
-        # entry state is reading for MAIL FROM cmd
-        cstate = WAIT
+    # runs one step of the state machine on a single line read off the connection
+    # message body lines go to the spool as the raw bytes that came in,
+    # everything else is parsed as a command first
+    # a line with no '\n' is a piece of one too long for the LineBuffer, the
+    # rest of it comes in the lines after
+    def feed(self, line):
+        cont = self.partial
+        self.partial = line[-1:] != b'\n'
+
+        if self.cstate == DATA:
+            rcode = self._expect_data(line, cont)
+
+            # the data state keeps consuming input until the terminator shows up
+            if rcode is None:
+                return
+        elif cont or self.partial:
+            # an overlong command is dropped a piece at a time and answered
+            # once its end comes in
+            if self.partial:
+                return
+
+            self._so_sock('500 Line too long')
+            rcode = ERR
+        else:
+            # bytes that aren't utf-8 come through as U+FFFD instead of
+            # raising, which would take the whole blocking loop down
+            result = self.parser.parse(line.decode(errors='replace'))
+
+            # RSET is good in any state, and a BDAT has to have its chunk read
+            # past in any state, so both are handled up front
+            if result.status == 0 and result.cmd == 5:
+                rcode = self._expect_rset(result)
+            elif result.status == 0 and result.cmd == 7:
+                rcode = self._expect_bdat(result)
+            else:
+                rcode = self.call[self.cstate](self, result)
 
-        while True:
-            rcode = self.call[cstate](self)
+        self._advance(rcode)
 
-            try:
-                cstate = self.transition[(cstate, rcode)]
-            except KeyError:
-                # if a error is recieved go back to the mail from state
-                cstate = QUIT
+        # a zero length chunk is already complete
+        if self.cstate == CHUNK and self.chunk_left == 0:
+            self.feed_chunk(b'')
 
-        # need a try except for socket OSErrors
-        
-    def _waitfor_connection(self):
-        self.csock, self.addr = self.sock.accept()
+    # runs the state machine on raw bytes of a BDAT chunk, which are never
+    # parsed or scanned, the loop asks wanted() how many to hand over
+    def feed_chunk(self, data):
+        rcode = self._expect_chunk(data)
 
-        self._so_sock('220 ' + socket.gethostname())
+        # more of the chunk to come
+        if rcode is None:
+            return
 
-        # HELO cmd response from client
-        cmd = self._rf_sock()
+        self._advance(rcode)
 
-        self.parser.parse(cmd)
+    # bytes of chunk data the session needs next, 0 when it wants a line
+    def wanted(self):
+        return self.chunk_left if self.cstate == CHUNK else 0
 
-        if self.parser.status == 0 and self.parser.cmd == 3:
-            self._so_sock('250 Hello ' + cmd[4:].rstrip().lstrip() + ', pleased to meet you')
+    def _advance(self, rcode):
+        try:
+            self.cstate = self.transition[(self.cstate, rcode)]
+        except KeyError:
+            # if a error is recieved the client is expected to quit
+            self.cstate = QUIT
+
+    # hands back everything queued since the last call, joined for a single send
+    # blocks until any delivery still waiting on an fsync is done
+    def take_replies(self):
+        out = []
+        for reply in self.replies:
+            if not isinstance(reply, str):
+                reply = '250 OK\n' if reply.exception() is None else '451 Requested action aborted: local error in processing\n'
+            out.append(reply)
+        self.replies = []
+
+        return ''.join(out).encode()
+
+    # deliveries the queued replies are still waiting on, for loops that
+    # can't block in take_replies
+    def waiting(self):
+        return [reply for reply in self.replies if not isinstance(reply, str) and not reply.done()]
+
+    def _expect_helo(self, result):
+        if result.status == 0 and result.cmd == 3:
+            self.helo = result.domain
+            self._so_sock('250 Hello ' + result.domain + ', pleased to meet you')
+        # EHLO gets the same greeting plus a line per extension
+        elif result.status == 0 and result.cmd == 6:
+            self.helo = result.domain
+            self._so_sock('250-Hello ' + result.domain + ', pleased to meet you')
+            for ext in EXTENSIONS[:-1]:
+                self._so_sock('250-' + ext)
+            self._so_sock('250 ' + EXTENSIONS[-1])
         else:
-            if self.parser.bad_token[-3:] == 'cmd':
+            if result.bad_token[-3:] == 'cmd':
                 self._so_sock('500 Syntax error: command unrecognized')
-            elif self.parser.cmd != 3:
+            elif result.cmd != 3 and result.cmd != 6:
                 self._so_sock("503 Bad sequence of commands")
             else:
                 self._so_sock('501 Syntax error in parameters or arguments')
@@ -113,136 +237,286 @@ class ServerLoop():
 
         return CMDOK
 
-    def _expect_mailf(self):
-        self.fpath = set()
-        self.buffer = []
-        
-        cmd = self._rf_sock()
+    # drops the spool of a message that is finished with or abandoned
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
 
-        self.parser.parse(cmd)
+    def _expect_mailf(self, result):
+        self.fpath = set()
+        self.close()
 
-        if self.parser.status == 0 and self.parser.cmd == 0:            
+        if result.status == 0 and result.cmd == 0 and self.helo != '':
             self._so_sock('250 OK')
             # return transition to rcpt to state
             return CMDOK
+        # the client is done sending messages
+        elif result.status == 0 and result.cmd == 4:
+            return self._expect_quit(result)
         else:
-            if self.parser.bad_token[-3:] == 'cmd':
+            if result.bad_token[-3:] == 'cmd':
                 self._so_sock('500 Syntax error: command unrecognized')
-            elif self.parser.cmd != 0:
+            # no HELO yet counts as out of order too
+            elif result.cmd != 0 or self.helo == '':
                 self._so_sock("503 Bad sequence of commands")
             else:
                 self._so_sock('501 Syntax error in parameters or arguments')
-    
+
             return ERR
 
-    def _expect_rcpt(self):
-        cmd = self._rf_sock()
-        
-        self.parser.parse(cmd)
+    def _expect_rcpt(self, result):
+        if result.status == 0 and result.cmd == 1:
+            if not valid_name(result.domain):
+                return self._bad_mailbox()
+
+            self.fpath.add(result.domain)
 
-        if self.parser.status == 0 and self.parser.cmd == 1:
-            self.fpath.add(self._get_domain(self._get_path(cmd)))
-            
             self._so_sock('250 OK')
-            
+
             return CMDOK
         else:
-            if self.parser.bad_token[-3:] == 'cmd':
+            if result.bad_token[-3:] == 'cmd':
                 self._so_sock('500 Syntax error: command unrecognized')
-            elif self.parser.cmd >= 0:
+            elif result.cmd >= 0:
                 self._so_sock("503 Bad sequence of commands")
             else:
                 self._so_sock('501 Syntax error in parameters or arguments')
 
             return ERR
 
-    def _expect_ercpt(self):
-        cmd = self._rf_sock()
-        
-        self.parser.parse(cmd)
+    def _expect_ercpt(self, result):
+        if result.status == 0:
+            if result.cmd == 1:
+                if not valid_name(result.domain):
+                    return self._bad_mailbox()
+
+                self.fpath.add(result.domain)
 
-        if self.parser.status == 0:
-            if self.parser.cmd == 1:
-                self.fpath.add(self._get_domain(self._get_path(cmd)))
-                
                 self._so_sock('250 OK')
                 return CMDOK
             # when the rcpt parse fails, check for data
-            elif self.parser.cmd == 2:
+            elif result.cmd == 2:
                 # print intermediate response
                 self._so_sock('354 Start mail input; end with <CRLF>.<CRLF>')
+                self.spool = Spool(self.max_size)
                 return DATAPENDING
             # mail from command recieved
             else:
                 self._so_sock("503 Bad sequence of commands")
                 return ERR
         else:
-            if self.parser.bad_token[-3:] == 'cmd':
+            if result.bad_token[-3:] == 'cmd':
                 self._so_sock('500 Syntax error: command unrecognized')
-            elif self.parser.cmd >= 0:
+            elif result.cmd >= 0:
                 self._so_sock("503 Bad sequence of commands")
             else:
                 self._so_sock('501 Syntax error in parameters or arguments')
 
             return ERR
 
+    # the recipient parsed but can't be used as a mailbox name, it would
+    # land outside the store
+    def _bad_mailbox(self):
+        self._so_sock('553 Requested action not taken: mailbox name not allowed')
+
+        return ERR
+
+    # drops the transaction in progress, the client has to start over with
+    # MAIL FROM, or with HELO if it never got one accepted
+    def _expect_rset(self, result):
+        self.fpath = set()
+        self.close()
+
+        self._so_sock('250 OK')
+
+        if self.helo == '':
+            return RSETNOHELO
+
+        return RSETOK
+
+    # BDAT starts a message after at least one RCPT TO, or carries on one
+    # already started by an earlier BDAT
+    def _expect_bdat(self, result):
+        if result.status == 0 and result.cmd == 7:
+            self.chunk_left = result.size
+            self.chunk_last = result.last
+
+            if self.cstate in (ERT, BDAT):
+                if self.spool is None:
+                    self.spool = Spool(self.max_size)
+                self.chunk_err = ''
+            else:
+                # still has to read past the chunk before saying no
+                self.chunk_err = '503 Bad sequence of commands'
+
+            return CHUNKPENDING
+        else:
+            if result.bad_token[-3:] == 'cmd':
+                self._so_sock('500 Syntax error: command unrecognized')
+            elif result.cmd >= 0 and result.cmd != 7:
+                self._so_sock("503 Bad sequence of commands")
+            else:
+                self._so_sock('501 Syntax error in parameters or arguments')
+
+            return ERR
+
+    # copies chunk bytes straight into the spool, they are never looked at
+    def _expect_chunk(self, data):
+        if self.chunk_err == '':
+            self.spool.write(data)
+        self.chunk_left -= len(data)
+
+        if self.chunk_left > 0:
+            return None
+
+        if self.chunk_err != '':
+            self._so_sock(self.chunk_err)
+            self.chunk_err = ''
+            return ERR
+
+        if not self.chunk_last:
+            self._so_sock('250 OK')
+            return CHUNKOK
+
+        return self._finish_message()
+
     # used for parsing the data of the email itself and not the data cmd
-    def _expect_data(self):
-        acc = False
-        text = self._rf_sock()
-        while text != '':
-            if text[-3:] == '\n.\n':
-                self.buffer.append(text[:-2])
-                acc = True
-                break
-            
-            self.buffer.append(text)
-            
-            text = self._rf_sock()
-        
-        if acc is True:
+    # gets called once per line until the terminator line is seen
+    # a line the client dot-stuffed gets its extra leading '.' taken back off
+    # cont marks the rest of a line too long to come in one piece, which is
+    # spooled as it is. the spool's size cap still applies to it
+    def _expect_data(self, text, cont=False):
+        if cont:
+            self.spool.write(text)
+            return None
+
+        if text != b'.\n':
+            self.spool.write(text[1:] if text[:1] == b'.' else text)
+            return None
+
+        return self._finish_message()
+
+    # delivers the spooled message once the whole thing has come in
+    def _finish_message(self):
+        if self.spool.overflow:
+            self.close()
+            self._so_sock(f'552 Message size exceeds fixed maximum message size of {self.max_size} bytes')
+            return TOOBIG
+
+        # append to, or create, a file for each path specified in RCPT TO
+        durable = self.store.deliver(self.spool, self.fpath)
+        self.close()
+
+        # a strict DeliveryQueue hands back a Future, the reply waits in line
+        # for it so nothing after it goes out before the message is on disk
+        if durable is None:
             self._so_sock('250 OK')
+        else:
+            self.replies.append(durable)
 
-            for path in self.fpath:
-                # open or create a file for each path specified in RCPT TO
-                with open(f'forward/{path}', "a") as fout:
-                    fout.writelines(self.buffer)
-            
-            return CMDOK
-        
-        return "i think this should be ERR?"
-    
-    def _expect_quit(self):
-        cmd = self._rf_sock()
-        
-        self.parser.parse(cmd)
-
-        if self.parser.status == 0 and self.parser.cmd == 4:
-            self._so_sock('221 ' + socket.gethostname() + ' closing connection')
+        return CMDOK
 
-            self.csock.close()
+    def _expect_quit(self, result):
+        if result.status == 0 and result.cmd == 4:
+            self._so_sock('221 ' + socket.gethostname() + ' closing connection')
 
-            self.csock = None
-            self.addr = None
+            self.done = True
 
             return CONNECTTMN
         else:
-            if self.parser.bad_token[-3:] == 'cmd':
+            if result.bad_token[-3:] == 'cmd':
                 self._so_sock('500 Syntax error: command unrecognized')
-            elif self.parser.cmd != 4:
+            elif result.cmd != 4:
                 self._so_sock("503 Bad sequence of commands")
             else:
                 self._so_sock('501 Syntax error in parameters or arguments')
 
             return ERR
 
-    # takes a syntactically valid command and extracts the path
-    def _get_path(self, cmd):
-        return cmd[cmd.find('<')+1:cmd.find('>')]
+    # queue a response code to go back over the connection
+    def _so_sock(self, msg):
+        self.replies.append(msg + '\n')
+
+# blocking server, serves one connection at a time to completion
+class ServerLoop():
+    def __init__(self, port_num, max_size=MAX_MSG_SIZE, store=None):
+        # the same senders and recipients come up in nearly every
+        # transaction, the cache saves re-validating them each time
+        self.parser = CMDParser(path_cache=PathCache(PATH_CACHE_SIZE))
+        self.max_size = max_size
+        self.store = FlatStore() if store is None else store
+
+        self.sock = None
+        self.pnum = port_num
+        self.csock = None
+        self.addr = None
+        self.lines = None
+
+    def run(self):
+        # creates a socket
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.sock.bind(('', self.pnum))
+            self.sock.listen(MAX_CONNECTION_REQS)
+        except OSError:
+            print('Server socket establishment failed, perhaps the port number is already in use')
+            return
+
+        try:
+            while True:
+                self._waitfor_connection()
+
+                session = Session(self.parser, self.max_size, self.store)
+                try:
+                    self._serve(session)
+                except OSError:
+                    # connection dropped out from under us, go back to accepting
+                    pass
+                session.close()
+
+                self.csock.close()
+                self.csock = None
+                self.addr = None
+        finally:
+            # anything the store still has queued up gets written out
+            self.store.close()
 
-    # takes a path and extracts the domain name
-    def _get_domain(self, cmd):
-        return cmd[cmd.find('@')+1:]
+    def _waitfor_connection(self):
+        self.csock, self.addr = self.sock.accept()
+        # replies are already batched up by _serve, a reply written while the
+        # client is still mid chunk shouldn't wait on Nagle (asyncio sets this
+        # on its own sockets)
+        self.csock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lines = LineBuffer(BUFSIZE)
+
+    # drives the session state machine until the client quits or hangs up
+    # every command already in the buffer is run before the replies go out
+    # together, so a pipelining client gets a whole group answered in one send
+    def _serve(self, session):
+        session.start()
+        self._so_sock(session.take_replies())
+
+        while not session.done:
+            # BDAT chunks are handed over as raw bytes, everything else a line at a time
+            want = session.wanted()
+            cmd = self.lines.read(want) if want > 0 else self.lines.readline()
+            if cmd is None:
+                # out of buffered commands, flush before blocking on the socket
+                self._so_sock(session.take_replies())
+
+                # client closed the connection without a QUIT
+                if self.lines.fill(self.csock) == 0:
+                    return
+
+                continue
+
+            if want > 0:
+                session.feed_chunk(cmd)
+            else:
+                session.feed(cmd)
+
+        self._so_sock(session.take_replies())
 
     # no longer used
     def _echo(self, line):
@@ -251,26 +525,157 @@ class ServerLoop():
         # eof inputted exit
         else:
             exit(0)
-    
-    # read data from the connection socket
-    def _rf_sock(self):
-        data = self.csock.recv(BUFSIZE)
-
-        # TODO actually handle case where nothing is recv'd
-        if data == b'':
-            print("nothing recv'd")
-
-        return data.decode()
-    
-    # send response code back over connection socket
+
+    # send queued response codes back over connection socket
     def _so_sock(self, msg):
-        msg = msg + '\n'
-        self.csock.send(msg.encode())
+        if msg != b'':
+            self.csock.sendall(msg)
+
+# asyncio server, runs one session task per connection so a slow client
+# only ever holds up its own session
+class AsyncServerLoop():
+    def __init__(self, port_num, backlog=ASYNC_BACKLOG, max_sessions=ASYNC_MAX_SESSIONS, max_size=MAX_MSG_SIZE, store=None):
+        # the parser keeps no per-line state, so one instance and its path
+        # cache are shared by all sessions
+        self.parser = CMDParser(path_cache=PathCache(PATH_CACHE_SIZE))
+
+        self.pnum = port_num
+        self.backlog = backlog
+        self.max_sessions = max_sessions
+        self.max_size = max_size
+        self.store = FlatStore() if store is None else store
+        self.active = 0
+
+        self.server = None
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.store.close()
+
+    async def serve(self):
+        if not await self.start():
+            return
+
+        # SIGTERM stops the server the same as ctrl-c, run() then closes the
+        # store so a DeliveryQueue writes out what it holds
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+
+        async with self.server:
+            await stop.wait()
+
+    # binds the listening socket, returns False if that fails
+    async def start(self):
+        try:
+            self.server = await asyncio.start_server(
+                self._session, port=self.pnum, backlog=self.backlog, reuse_address=True)
+        except OSError:
+            print('Server socket establishment failed, perhaps the port number is already in use')
+            return False
+
+        return True
+
+    async def _session(self, reader, writer):
+        # over the connection cap, turn the client away instead of queueing it
+        if self.active >= self.max_sessions:
+            writer.write(f'421 {socket.gethostname()} Service not available, too many connections\n'.encode())
+            await self._close(writer)
+            return
+
+        self.active += 1
+        session = Session(self.parser, self.max_size, self.store)
+        lines = LineBuffer(BUFSIZE)
+        try:
+            session.start()
+            writer.write(session.take_replies())
+            await writer.drain()
+
+            while not session.done:
+                want = session.wanted()
+                cmd = lines.read(want) if want > 0 else lines.readline()
+                if cmd is None:
+                    # out of buffered commands, flush before waiting on the client
+                    await self._flush(session, writer)
+
+                    data = await reader.read(BUFSIZE)
+
+                    # client closed the connection without a QUIT
+                    if data == b'':
+                        break
+
+                    lines.feed(data)
+                    continue
+
+                if want > 0:
+                    session.feed_chunk(cmd)
+                else:
+                    session.feed(cmd)
+
+            await self._flush(session, writer)
+        except OSError:
+            pass
+        finally:
+            self.active -= 1
+            session.close()
+            await self._close(writer)
+
+    # sends the session's replies, other sessions keep being served while
+    # any strict deliveries among them are waiting on their fsync
+    async def _flush(self, session, writer):
+        waiting = session.waiting()
+        if len(waiting) > 0:
+            await asyncio.wait([asyncio.wrap_future(durable) for durable in waiting])
+
+        writer.write(session.take_replies())
+        await writer.drain()
+
+    async def _close(self, writer):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+# SIGTERM is turned into a normal exit for the blocking loop, so its finally
+# still closes the store and a DeliveryQueue writes out what it holds
+def _terminate(signum, frame):
+    exit(0)
 
 if __name__ == "__main__":
     if len(argv) < 2:
         # not enough arguments
         exit(1)
     else:
-        cli = ServerLoop(int(argv[1]))
-        cli.run()
\ No newline at end of file
+        port = int(argv[1])
+        args = argv[2:]
+
+        # Server.py <port> flat|sharded|segments|blobs ... picks where mail
+        # is kept, the flat forward/ files when left out
+        store = FlatStore()
+        if len(args) > 0 and args[0] in STORES:
+            store = STORES[args[0]]()
+            args = args[1:]
+
+        # Server.py <port> [store] queue|strict ... puts a group commit
+        # DeliveryQueue in front of the store, strict only sends 250 once the
+        # message has been fsynced
+        if len(args) > 0 and args[0] in ('queue', 'strict'):
+            store = DeliveryQueue(store, strict=args[0] == 'strict')
+            args = args[1:]
+
+        if len(args) > 0 and args[0] == 'async':
+            # Server.py <port> [store] [queue|strict] async [max sessions] [backlog]
+            max_sessions = int(args[1]) if len(args) > 1 else ASYNC_MAX_SESSIONS
+            backlog = int(args[2]) if len(args) > 2 else ASYNC_BACKLOG
+
+            cli = AsyncServerLoop(port, backlog, max_sessions, store=store)
+            cli.run()
+        else:
+            signal.signal(signal.SIGTERM, _terminate)
+
+            cli = ServerLoop(port, store=store)
+            cli.run()
@@ -0,0 +1,1060 @@
+# benchmarks for the mail server and its pieces
+# usage: python bench.py <benchmark> [args...]
+#
+#   server [blocking|async] [concurrency ...]
+#       messages/sec through Server.py as the number of concurrent
+#       clients grows
+#   load [blocking|async] [clients] [messages] [sizes] [recipients]
+#       load generation against Server.py, printed as JSON: messages/sec,
+#       bytes/sec and p50/p95/p99 latency of every command. sizes and
+#       recipients are value:weight lists to draw each message from, like
+#       1024:8,65536:2 for four in five messages at 1 KB
+#   reuse [messages]
+#       Client.ClientLoop sending messages one connection each against
+#       queueing them all over a single session
+#   pipeline [rtt ms] [recipients ...]
+#       Client.ClientLoop with and without PIPELINING through a proxy that
+#       delays traffic by a simulated round trip time
+#   bdat [sizes ...]
+#       body throughput through Server.py sent with DATA, scanned line by
+#       line for the terminator, against one BDAT chunk of the same size
+#   senddata [body sizes ...]
+#       Client.ClientLoop sending with DATA, one send per header piece and
+#       body line as _send_data used to against the one sendall it does now,
+#       send calls and wall time per message
+#   fanout [body KB] [recipients ...]
+#       delivering one message to many mailboxes with the flat forward/
+#       files, the segmented store and the single instance blob store
+#   commit [writers] [messages]
+#       strict DeliveryQueue throughput and ack latency with concurrent
+#       writers, fsyncing every message on its own against group commit
+#   handles [mailboxes] [messages]
+#       small messages to a few hundred hot mailboxes through a FlatStore,
+#       opening every file each time against the handle cache
+#   reader [messages]
+#       counting and reading every message of a big mailbox file loaded
+#       and split in Python against the mmap MailboxReader, plus opening it
+#       again with the sidecar index
+#   replay [messages]
+#       SMTP2.py replaying a forward file against recorded acks, the
+#       line at a time mode against stream mode. output must match
+#   parse [lengths ...]
+#       CMDParser over tests/parse.txt and over synthetic addresses of
+#       growing length, regex fast path against the plain descent parser.
+#       ns/char stays flat when parsing is linear
+#   parsediff [count] [seed]
+#       differential check, the fast path (with and without a path cache)
+#       and the descent parser must give the same results on tests/parse.txt
+#       plus a generated corpus
+#   pathcache [lines] [hot paths]
+#       MAIL FROM/RCPT TO traffic drawn mostly from a small set of hot
+#       addresses, parsed with and without a PathCache
+#   parsemany [lines]
+#       lines/sec replaying a transcript through the parse.py driver, one
+#       parse and print per line against parse_many with buffered output
+
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from sys import argv, executable
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CONCURRENCY = [1, 10, 100, 1000]
+DEFAULT_ADDR_LENGTHS = [16, 64, 256, 1024, 4096, 16384]
+PARSE_FIXTURE = os.path.join(HERE, 'tests', 'parse.txt')
+# roughly how long each parse measurement should run for, in seconds
+PARSE_SECS = 0.5
+DIFF_CORPUS_SIZE = 100000
+TRANSCRIPT_LINES = 500000
+CACHE_BENCH_LINES = 200000
+CACHE_BENCH_HOT = 200
+MSGS_PER_LEVEL = 2000
+# seconds a single message may take before it is counted as an error
+# the blocking server's one-deep listen queue drops handshakes under load and
+# those clients would otherwise sit waiting on a banner that never comes
+MSG_TIMEOUT = 5
+REUSE_MSGS = 2000
+LOAD_CLIENTS = 10
+LOAD_MSGS = 2000
+LOAD_SIZES = '1024:8,16384:2'
+LOAD_RCPTS = '1:8,5:2'
+LOAD_PERCENTILES = [50, 95, 99]
+PIPELINE_RTT_MS = 20
+PIPELINE_RCPTS = [1, 10, 100]
+PIPELINE_MSGS = 5
+DEFAULT_BODY_SIZES = [1 << 10, 100 << 10, 1 << 20, 10 << 20, 100 << 20]
+# roughly how long each body size is sent over and over for, in seconds
+BODY_SECS = 1
+SENDDATA_SIZES = [1 << 10, 10 << 10, 100 << 10, 1 << 20]
+# about how much each body size sends in all, messages = this / size
+SENDDATA_BYTES = 20 << 20
+FANOUT_BODY_KB = 1024
+FANOUT_RCPTS = [1, 10, 100]
+FANOUT_MSGS = 5
+COMMIT_WRITERS = 32
+COMMIT_MSGS = 2000
+HANDLE_MAILBOXES = 200
+HANDLE_MSGS = 20000
+READER_MSGS = 200000
+REPLAY_MSGS = 50000
+
+# ###### helpers ######
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# starts Server.py in a scratch directory with a forward/ dir to deliver into
+# returns the process and the port it listens on
+def start_server(workdir, *args):
+    os.makedirs(os.path.join(workdir, 'forward'), exist_ok=True)
+    port = free_port()
+
+    proc = subprocess.Popen(
+        [executable, os.path.join(HERE, 'Server.py'), str(port), *args],
+        cwd=workdir, stdout=subprocess.DEVNULL)
+
+    # wait for the listening socket to come up
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    return proc, port
+
+def stop_server(proc):
+    proc.terminate()
+    proc.wait()
+
+# ###### server throughput ######
+
+# one message in the same lockstep HELO/MAIL/RCPT/DATA/QUIT dialogue as
+# Client.ClientLoop without extensions. with latencies given, the greeting
+# and every command are timed from write to reply into its lists. returns
+# the bytes of message sent
+async def send_one(port, sender, rcpts, body, latencies=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    async def cmd(name, line, expect):
+        start = time.perf_counter()
+        writer.write(line)
+        ack = await reader.readline()
+        if latencies is not None:
+            latencies[name].append(time.perf_counter() - start)
+
+        if ack[:3] != expect:
+            raise RuntimeError(f'expected {expect.decode()} after {name}, got {ack!r}')
+
+    try:
+        start = time.perf_counter()
+        greeting = await reader.readline()
+        if latencies is not None:
+            latencies['connect'].append(time.perf_counter() - start)
+
+        if greeting[:3] != b'220':
+            raise RuntimeError(f'expected 220 greeting, got {greeting!r}')
+
+        await cmd('HELO', b'HELO bench\n', b'250')
+        await cmd('MAIL', f'MAIL FROM: <{sender}>\n'.encode(), b'250')
+        for rcpt in rcpts:
+            await cmd('RCPT', f'RCPT TO: <{rcpt}>\n'.encode(), b'250')
+        await cmd('DATA', b'DATA\n', b'354')
+
+        to = ', '.join(f'<{rcpt}>' for rcpt in rcpts)
+        msg = f'From: <{sender}>\nTo: {to}\nSubject: bench\n\n'.encode() + body + b'.\n'
+        await cmd('message', msg, b'250')
+        await cmd('QUIT', b'QUIT\n', b'221')
+    finally:
+        writer.close()
+
+    return len(msg)
+
+async def drive(port, concurrency, total):
+    body = b'x' * 70 + b'\n'
+    sent = 0
+    errors = 0
+
+    async def worker(n):
+        nonlocal sent, errors
+        for i in range(n):
+            try:
+                await asyncio.wait_for(
+                    send_one(port, 'bench@load.gen', [f'user{i}@bench{i % 8}.test'], body), MSG_TIMEOUT)
+                sent += 1
+            except (OSError, RuntimeError, asyncio.TimeoutError):
+                errors += 1
+
+    per_worker = max(1, total // concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(per_worker) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return sent, errors, elapsed
+
+def bench_server(args):
+    mode = 'async'
+    if args and args[0] in ('blocking', 'async'):
+        mode = args[0]
+        args = args[1:]
+    levels = [int(a) for a in args] if args else DEFAULT_CONCURRENCY
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # headroom for slots still held by sessions that just sent their 221
+        proc, port = start_server(workdir, *(['async', str(2 * max(levels))] if mode == 'async' else []))
+        try:
+            print(f'{mode} server, {MSGS_PER_LEVEL} messages per level')
+            print(f'{"clients":>8} {"sent":>8} {"errors":>8} {"secs":>8} {"msgs/sec":>10}')
+            for c in levels:
+                sent, errors, elapsed = asyncio.run(drive(port, c, MSGS_PER_LEVEL))
+                print(f'{c:>8} {sent:>8} {errors:>8} {elapsed:>8.2f} {sent / elapsed:>10.1f}')
+        finally:
+            stop_server(proc)
+
+# ###### load generation ######
+
+# 'value:weight,...' -> (values, weights), a missing weight counts as 1
+def parse_distribution(spec):
+    values = []
+    weights = []
+    for part in spec.split(','):
+        value, _, weight = part.partition(':')
+        values.append(int(value))
+        weights.append(float(weight) if weight else 1.0)
+
+    return values, weights
+
+# nearest rank percentile of an already sorted list
+def percentile(ordered, p):
+    if not ordered:
+        return None
+
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+async def generate_load(port, clients, total, sizes, rcpt_counts):
+    rng = random.Random(0)
+    line = b'x' * 70 + b'\n'
+    latencies = {name: [] for name in ('connect', 'HELO', 'MAIL', 'RCPT', 'DATA', 'message', 'QUIT')}
+    counts = {'sent': 0, 'errors': 0, 'bytes': 0}
+
+    # every message is drawn up front so the clients don't share the rng
+    plan = []
+    for i in range(total):
+        size = rng.choices(*sizes)[0]
+        nrcpts = rng.choices(*rcpt_counts)[0]
+        body = line * (size // len(line)) + b'x' * (size % len(line))
+        if body[-1:] != b'\n':
+            body += b'\n'
+        plan.append((f'bench{i}@load.gen', [f'user{j}@bench{(i + j) % 8}.test' for j in range(nrcpts)], body))
+    pending = iter(plan)
+
+    async def client():
+        for sender, rcpts, body in pending:
+            try:
+                sent = await asyncio.wait_for(send_one(port, sender, rcpts, body, latencies), MSG_TIMEOUT)
+                counts['bytes'] += sent
+                counts['sent'] += 1
+            except (OSError, RuntimeError, asyncio.TimeoutError):
+                counts['errors'] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    return counts, latencies, elapsed
+
+def bench_load(args):
+    mode = 'blocking'
+    if args and args[0] in ('blocking', 'async'):
+        mode = args[0]
+        args = args[1:]
+    clients = int(args[0]) if len(args) > 0 else LOAD_CLIENTS
+    total = int(args[1]) if len(args) > 1 else LOAD_MSGS
+    size_spec = args[2] if len(args) > 2 else LOAD_SIZES
+    rcpt_spec = args[3] if len(args) > 3 else LOAD_RCPTS
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # a session's slot is only freed once its 221 is out, so a client
+        # reconnecting straight away can find all of them still taken
+        proc, port = start_server(workdir, *(['async', str(2 * clients)] if mode == 'async' else []))
+        try:
+            counts, latencies, elapsed = asyncio.run(generate_load(
+                port, clients, total, parse_distribution(size_spec), parse_distribution(rcpt_spec)))
+        finally:
+            stop_server(proc)
+
+    report = {
+        'server': mode,
+        'clients': clients,
+        'messages': total,
+        'sizes': size_spec,
+        'recipients': rcpt_spec,
+        'sent': counts['sent'],
+        'errors': counts['errors'],
+        'seconds': round(elapsed, 3),
+        'msgs_per_sec': round(counts['sent'] / elapsed, 1),
+        'bytes_per_sec': round(counts['bytes'] / elapsed, 1),
+        'latency_ms': {}
+    }
+    for name, samples in latencies.items():
+        samples.sort()
+        report['latency_ms'][name] = {'count': len(samples)}
+        for p in LOAD_PERCENTILES:
+            value = percentile(samples, p)
+            report['latency_ms'][name][f'p{p}'] = None if value is None else round(value * 1000, 3)
+
+    print(json.dumps(report, indent=2))
+
+# ###### connection reuse ######
+
+def bench_reuse(args):
+    from Client import ClientLoop
+
+    count = int(args[0]) if args else REUSE_MSGS
+    body = ['x' * 70 + '\n'] * 4
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, port = start_server(workdir)
+        try:
+            start = time.perf_counter()
+            for i in range(count):
+                cli = ClientLoop('127.0.0.1', port)
+                cli.queue('bench@load.gen', [f'user{i}@bench{i % 8}.test'], 'bench\n', body)
+                cli.run()
+            single = time.perf_counter() - start
+
+            start = time.perf_counter()
+            cli = ClientLoop('127.0.0.1', port)
+            for i in range(count):
+                cli.queue('bench@load.gen', [f'user{i}@bench{i % 8}.test'], 'bench\n', body)
+            cli.run()
+            reused = time.perf_counter() - start
+        finally:
+            stop_server(proc)
+
+    print(f'{"connection per message":>24}: {count / single:>8.0f} msgs/sec')
+    print(f'{"one session":>24}: {count / reused:>8.0f} msgs/sec')
+
+# ###### pipelining under latency ######
+
+# relays every connection made to it on to the server at port, holding each
+# chunk back for half of rtt in both directions. runs on its own thread and
+# returns the port it listens on
+def start_delay_proxy(port, rtt):
+    ready = threading.Event()
+    listen = []
+
+    async def relay(reader, writer):
+        pending = asyncio.Queue()
+
+        async def pump():
+            while True:
+                data = await reader.read(65536)
+                await pending.put((time.monotonic() + rtt / 2, data))
+                if data == b'':
+                    return
+
+        async def deliver():
+            while True:
+                due, data = await pending.get()
+                await asyncio.sleep(max(0, due - time.monotonic()))
+                if data == b'':
+                    writer.close()
+                    return
+                writer.write(data)
+                await writer.drain()
+
+        try:
+            await asyncio.gather(pump(), deliver())
+        except OSError:
+            writer.close()
+
+    async def accept(creader, cwriter):
+        sreader, swriter = await asyncio.open_connection('127.0.0.1', port)
+        await asyncio.gather(relay(creader, swriter), relay(sreader, cwriter))
+
+    async def serve():
+        server = await asyncio.start_server(accept, '127.0.0.1', 0)
+        listen.append(server.sockets[0].getsockname()[1])
+        ready.set()
+        await server.serve_forever()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    ready.wait()
+
+    return listen[0]
+
+def bench_pipeline(args):
+    from Client import ClientLoop
+
+    rtt = (float(args[0]) if args else PIPELINE_RTT_MS) / 1000
+    counts = [int(a) for a in args[1:]] if len(args) > 1 else PIPELINE_RCPTS
+    body = ['x' * 70 + '\n'] * 4
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, port = start_server(workdir)
+        try:
+            proxy = start_delay_proxy(port, rtt)
+
+            print(f'{rtt * 1000:.0f}ms rtt, {PIPELINE_MSGS} messages per run over one session')
+            print(f'{"rcpts":>8} {"lockstep ms":>12} {"pipelined ms":>13}')
+            for n in counts:
+                rcpts = [f'user{i}@bench{i % 8}.test' for i in range(n)]
+
+                times = []
+                for pipelining in (False, True):
+                    cli = ClientLoop('127.0.0.1', proxy, pipelining)
+                    for _ in range(PIPELINE_MSGS):
+                        cli.queue('bench@load.gen', rcpts, 'bench\n', body)
+
+                    start = time.perf_counter()
+                    cli.run()
+                    times.append((time.perf_counter() - start) / PIPELINE_MSGS * 1000)
+
+                print(f'{n:>8} {times[0]:>12.1f} {times[1]:>13.1f}')
+        finally:
+            stop_server(proc)
+
+# ###### DATA against BDAT ######
+
+# Server.py's command line has no message size limit, so for bodies past the
+# default the blocking loop is started straight from the module
+def start_server_sized(workdir, max_size):
+    os.makedirs(os.path.join(workdir, 'forward'), exist_ok=True)
+    port = free_port()
+
+    code = f'import sys; sys.path.insert(0, {HERE!r}); import Server; Server.ServerLoop({port}, {max_size}).run()'
+    proc = subprocess.Popen([executable, '-c', code], cwd=workdir, stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    return proc, port
+
+# reads n replies off a file made from the socket, failing on anything unexpected
+def expect_replies(replies, n, code=b'250'):
+    for _ in range(n):
+        reply = replies.readline()
+        while reply[3:4] == b'-':
+            reply = replies.readline()
+
+        if reply[:3] != code:
+            raise RuntimeError(f'expected {code.decode()}, got {reply!r}')
+
+def send_data(sock, replies, body):
+    sock.sendall(b'MAIL FROM: <bench@load.gen>\nRCPT TO: <user@bench.test>\nDATA\n')
+    expect_replies(replies, 2)
+    expect_replies(replies, 1, b'354')
+
+    sock.sendall(body)
+    sock.sendall(b'.\n')
+    expect_replies(replies, 1)
+
+def send_bdat(sock, replies, body):
+    sock.sendall(b'MAIL FROM: <bench@load.gen>\nRCPT TO: <user@bench.test>\nBDAT %d LAST\n' % len(body))
+    sock.sendall(body)
+    expect_replies(replies, 3)
+
+def bench_bdat(args):
+    sizes = [int(a) for a in args] if args else DEFAULT_BODY_SIZES
+    line = b'x' * 70 + b'\n'
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, port = start_server_sized(workdir, max(sizes) * 2)
+        try:
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            replies = sock.makefile('rb')
+            expect_replies(replies, 1, b'220')
+            sock.sendall(b'EHLO bench\n')
+            expect_replies(replies, 1)
+
+            print(f'{"body":>10} {"DATA MB/s":>10} {"BDAT MB/s":>10}')
+            for size in sizes:
+                body = line * (size // len(line)) + b'x' * (size % len(line) - 1) + b'\n'
+
+                rates = []
+                for send in (send_data, send_bdat):
+                    count = 0
+                    start = time.perf_counter()
+                    elapsed = 0
+                    while elapsed < BODY_SECS:
+                        send(sock, replies, body)
+                        count += 1
+                        elapsed = time.perf_counter() - start
+
+                        # the forward file would otherwise grow by gigabytes
+                        os.truncate(os.path.join(workdir, 'forward', 'bench.test'), 0)
+
+                    rates.append(count * size / elapsed / (1 << 20))
+
+                print(f'{size:>10} {rates[0]:>10.1f} {rates[1]:>10.1f}')
+
+            sock.sendall(b'QUIT\n')
+            sock.close()
+        finally:
+            stop_server(proc)
+
+# ###### DATA writes ######
+
+# stands in for the client's socket, counting the sends that reach the kernel
+class CountingSocket():
+    def __init__(self, sock):
+        self.sock = sock
+        self.sends = 0
+
+    def send(self, data):
+        self.sends += 1
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        self.sends += 1
+        return self.sock.sendall(data)
+
+    def recv_into(self, buf):
+        return self.sock.recv_into(buf)
+
+    def close(self):
+        self.sock.close()
+
+# Client.ClientLoop._send_data as it was, a send for every piece of the
+# header and every line of the body
+def send_data_per_line(cli):
+    msg = f'From: <{cli.msg_contents[0]}>\nTo: '
+    cli.servsock.send(msg.encode())
+
+    msg = ''
+    for rcpt in cli.msg_contents[1]:
+        msg += f'<{rcpt}>'
+
+        cli.servsock.send(msg.encode())
+        msg = ', '
+
+    msg = f'\nSubject: {cli.msg_contents[2]}\n'
+    cli.servsock.send(msg.encode())
+
+    for msg in cli.msg_contents[3]:
+        cli.servsock.send(msg.encode())
+
+    cli.servsock.send('.\n'.encode())
+
+    return cli._finish_msg(cli._get_ack())
+
+# runs count messages with the given body over one DATA session
+# returns the seconds taken and the send calls _send_data made
+def time_send_data(port, body, count, send_data):
+    from Client import ClientLoop, HELO, DATA
+
+    sends = 0
+
+    def hello(cli):
+        result = ClientLoop._send_hello(cli)
+        cli.servsock = CountingSocket(cli.servsock)
+        return result
+
+    def data(cli):
+        nonlocal sends
+        before = cli.servsock.sends
+        result = send_data(cli)
+        sends += cli.servsock.sends - before
+        return result
+
+    cli = ClientLoop('127.0.0.1', port, pipelining=False, chunking=False)
+    cli.call[HELO] = hello
+    cli.call[DATA] = data
+    for i in range(count):
+        cli.queue('bench@load.gen', [f'user{i % 4}@bench.test', f'copy{i % 4}@bench.test'], 'bench\n', body)
+
+    start = time.perf_counter()
+    cli.run()
+
+    return time.perf_counter() - start, sends
+
+def bench_send_data(args):
+    from Client import ClientLoop
+
+    sizes = [int(a) for a in args] if args else SENDDATA_SIZES
+    line = 'x' * 70 + '\n'
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, port = start_server_sized(workdir, max(sizes) * 2)
+        try:
+            print(f'{"body":>10} {"msgs":>6} {"per-line sends":>15} {"ms/msg":>8} {"sendall sends":>14} {"ms/msg":>8}')
+            for size in sizes:
+                body = [line] * max(1, size // len(line))
+                count = max(5, min(1000, SENDDATA_BYTES // size))
+
+                row = []
+                for send_data in (send_data_per_line, ClientLoop._send_data):
+                    elapsed, sends = time_send_data(port, body, count, send_data)
+                    row += [sends / count, elapsed / count * 1000]
+
+                    # the forward file would otherwise grow by gigabytes
+                    os.truncate(os.path.join(workdir, 'forward', 'bench.test'), 0)
+
+                print(f'{size:>10} {count:>6} {row[0]:>15.0f} {row[1]:>8.3f} {row[2]:>14.0f} {row[3]:>8.3f}')
+        finally:
+            stop_server(proc)
+
+# ###### fan-out delivery ######
+
+# total size of every file under path
+def disk_bytes(path):
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(dirpath, f))
+
+    return total
+
+def bench_fanout(args):
+    from mailstore import Spool, FlatStore, SegmentStore, BlobStore
+
+    size = (int(args[0]) if args else FANOUT_BODY_KB) * 1024
+    counts = [int(a) for a in args[1:]] if len(args) > 1 else FANOUT_RCPTS
+    stores = (
+        ('flat', lambda root: FlatStore(root)),
+        ('segments', lambda root: SegmentStore(root)),
+        ('blobs', lambda root: BlobStore(root))
+    )
+
+    print(f'{size // 1024} KB body, {FANOUT_MSGS} messages per run')
+    print(f'{"rcpts":>6} {"store":>10} {"ms/msg":>10} {"MB written":>11}')
+    for n in counts:
+        names = [f'bench{i}.test' for i in range(n)]
+
+        for name, make in stores:
+            with tempfile.TemporaryDirectory() as root:
+                store = make(root)
+
+                elapsed = 0
+                for m in range(FANOUT_MSGS):
+                    spool = Spool(size + 64)
+                    # every message different, so nothing is shared across messages
+                    spool.write(b'%d\n' % m)
+                    spool.write(b'x' * (size - spool.size))
+
+                    start = time.perf_counter()
+                    store.deliver(spool, names)
+                    elapsed += time.perf_counter() - start
+
+                    spool.close()
+
+                written = disk_bytes(root) / (1 << 20)
+
+            print(f'{n:>6} {name:>10} {elapsed / FANOUT_MSGS * 1000:>10.2f} {written:>11.1f}')
+
+# ###### group commit ######
+
+def bench_commit(args):
+    from mailstore import Spool, FlatStore, DeliveryQueue
+
+    writers = int(args[0]) if args else COMMIT_WRITERS
+    total = int(args[1]) if len(args) > 1 else COMMIT_MSGS
+    body = b'x' * 1024
+
+    print(f'{writers} writers, {total} messages, strict acks')
+    print(f'{"":>18} {"msgs/sec":>10} {"p50 ms":>8} {"p99 ms":>8} {"batches":>8}')
+    for name, batch_size in (('fsync per message', 1), ('group commit', None)):
+        with tempfile.TemporaryDirectory() as root:
+            store = FlatStore(root)
+            if batch_size is None:
+                dq = DeliveryQueue(store, strict=True)
+            else:
+                dq = DeliveryQueue(store, strict=True, batch_size=batch_size)
+
+            latencies = []
+
+            def writer(n, w):
+                for i in range(n):
+                    spool = Spool()
+                    spool.write(body)
+
+                    start = time.perf_counter()
+                    dq.deliver(spool, [f'bench{(w + i) % 16}.test']).result()
+                    latencies.append(time.perf_counter() - start)
+
+                    spool.close()
+
+            threads = [threading.Thread(target=writer, args=(total // writers, w)) for w in range(writers)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+
+            dq.close()
+
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[len(latencies) * 99 // 100] * 1000
+        print(f'{name:>18} {len(latencies) / elapsed:>10.0f} {p50:>8.2f} {p99:>8.2f} {dq.batches:>8}')
+
+# ###### open file handles ######
+
+def bench_handles(args):
+    from mailstore import Spool, FlatStore, HANDLE_CACHE_SIZE
+
+    mailboxes = int(args[0]) if args else HANDLE_MAILBOXES
+    total = int(args[1]) if len(args) > 1 else HANDLE_MSGS
+    rng = random.Random(0)
+    rcpts = [[f'bench{rng.randrange(mailboxes)}.test' for _ in range(3)] for _ in range(total)]
+
+    spool = Spool()
+    spool.write(b'x' * 512)
+
+    print(f'{total} messages to 3 of {mailboxes} mailboxes each')
+    for name, size in (('no cache', 0), ('handle cache', HANDLE_CACHE_SIZE)):
+        with tempfile.TemporaryDirectory() as root:
+            store = FlatStore(root, size)
+
+            start = time.perf_counter()
+            for names in rcpts:
+                store.deliver(spool, names)
+            elapsed = time.perf_counter() - start
+
+            handles = store.handles
+            print(f'{name:>14}: {total / elapsed:>8.0f} msgs/sec, hit rate {handles.hit_rate():.2f}, '
+                  f'{handles.open_files()} open, {handles.evictions} evictions')
+            store.close()
+
+    spool.close()
+
+# ###### mailbox reader ######
+
+def bench_reader(args):
+    from mailreader import MailboxReader
+
+    total = int(args[0]) if args else READER_MSGS
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'bench.test')
+        with open(path, 'wb') as f:
+            for i in range(total):
+                f.write(b'From: <bench%d@load.gen>\nTo: <user@bench.test>\n' % i)
+                f.write(b'x' * 70 + b'\n' * rng.randrange(1, 20))
+        size = os.path.getsize(path)
+        picks = [rng.randrange(total) for _ in range(1000)]
+
+        print(f'{total} messages, {size >> 20} MB')
+
+        start = time.perf_counter()
+        with open(path, 'r') as f:
+            msgs = f.read().split('\nFrom: <')
+        count = len(msgs)
+        nbytes = sum(len(m) for m in msgs)
+        del msgs
+        print(f'{"read and split":>16}: {time.perf_counter() - start:.3f}s for {count} messages, {nbytes} chars')
+
+        start = time.perf_counter()
+        with MailboxReader(path) as reader:
+            nbytes = 0
+            for msg in reader:
+                nbytes += len(msg)
+                msg.release()
+        print(f'{"mmap iterate":>16}: {time.perf_counter() - start:.3f}s, {nbytes} bytes')
+
+        for label in ('index build', 'index reuse'):
+            start = time.perf_counter()
+            with MailboxReader(path, True) as reader:
+                count = len(reader)
+                for i in picks:
+                    reader[i].release()
+            print(f'{label:>16}: {time.perf_counter() - start:.3f}s for {count} messages and {len(picks)} lookups')
+
+# ###### forward file replay ######
+
+def bench_replay(args):
+    total = int(args[0]) if args else REPLAY_MSGS
+    ack_run = b'250 OK\n250 OK\n354 Start mail input; end with <CRLF>.<CRLF>\n250 OK\n'
+
+    with tempfile.TemporaryDirectory() as root:
+        forward = os.path.join(root, 'bench.test')
+        acks = os.path.join(root, 'acks')
+        with open(forward, 'wb') as f, open(acks, 'wb') as a:
+            for i in range(total):
+                f.write(b'From: <bench%d@load.gen>\nTo: <user@bench.test>\n' % i + b'x' * 70 + b'\n' * 10)
+                a.write(ack_run)
+
+        outputs = []
+        for mode in ([], ['stream']):
+            with open(acks, 'rb') as stdin:
+                start = time.perf_counter()
+                done = subprocess.run([executable, os.path.join(HERE, 'SMTP2.py'), forward] + mode,
+                                      stdin=stdin, capture_output=True)
+                elapsed = time.perf_counter() - start
+            outputs.append((done.stdout, done.stderr))
+
+            name = mode[0] if mode else 'per-line'
+            print(f'{name:>10}: {total} messages in {elapsed:.2f}s, {total / elapsed:.0f} msgs/sec')
+
+        print('output matches' if outputs[0] == outputs[1] else 'OUTPUT DIFFERS')
+
+# ###### parser ######
+
+# long local part plus a domain with many labels, about n chars in all
+def synthetic_mail_from(n):
+    labels = ['d' + str(i) for i in range(max(1, n // 32))]
+    domain = '.'.join(labels)
+
+    return f'MAIL FROM: <{"x" * max(1, n - len(domain))}@{domain}>\n'
+
+# calls parse on every line repeatedly for about PARSE_SECS
+# returns the mean seconds per parse call
+def time_parse(parser, lines):
+    reps = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < PARSE_SECS:
+        for line in lines:
+            parser.parse(line)
+        reps += 1
+        elapsed = time.perf_counter() - start
+
+    return elapsed / (reps * len(lines))
+
+def bench_parse(args):
+    from parse import CMDParser
+
+    fast = CMDParser()
+    descent = CMDParser(fast=False)
+    lengths = [int(a) for a in args] if args else DEFAULT_ADDR_LENGTHS
+
+    with open(PARSE_FIXTURE) as fixture:
+        lines = fixture.readlines()
+
+    for name, parser in (('fast path', fast), ('descent', descent)):
+        per = time_parse(parser, lines)
+        print(f'tests/parse.txt, {name}: {len(lines)} lines, {per * 1e6:.2f} usec/line, {1 / per:.0f} lines/sec')
+
+    print(f'{"chars":>8} {"fast usec":>10} {"ns/char":>8} {"descent usec":>13} {"ns/char":>8}')
+    for n in lengths:
+        line = synthetic_mail_from(n)
+        per_fast = time_parse(fast, [line])
+        per_descent = time_parse(descent, [line])
+        print(f'{len(line):>8} {per_fast * 1e6:>10.2f} {per_fast * 1e9 / len(line):>8.1f}'
+              f' {per_descent * 1e6:>13.2f} {per_descent * 1e9 / len(line):>8.1f}')
+
+# ###### parser differential check ######
+
+CORPUS_ALPHABET = 'MAILFROMRCPTDHEQUSB:<>@.,;()[]\\" \t\nabcxyz019_-!?'
+
+def random_string(rng, alphabet='abcdefxyz0123456789!#$%&*+-/=?^_`{|}~'):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 12)))
+
+def random_space(rng, least):
+    return ''.join(rng.choice(' \t') for _ in range(rng.randint(least, 3)))
+
+def random_domain(rng):
+    return '.'.join(random_string(rng) for _ in range(rng.randint(1, 4)))
+
+# a syntactically valid command, built straight from the grammar
+def random_command(rng):
+    path = f'<{random_string(rng)}@{random_domain(rng)}>'
+    return rng.choice([
+        f'MAIL{random_space(rng, 1)}FROM:{random_space(rng, 0)}{path}{random_space(rng, 0)}\n',
+        f'RCPT{random_space(rng, 1)}TO:{random_space(rng, 0)}{path}{random_space(rng, 0)}\n',
+        f'DATA{random_space(rng, 0)}\n',
+        f'HELO{random_space(rng, 1)}{random_domain(rng)}{random_space(rng, 0)}\n',
+        f'EHLO{random_space(rng, 1)}{random_domain(rng)}{random_space(rng, 0)}\n',
+        f'QUIT{random_space(rng, 0)}\n',
+        f'RSET{random_space(rng, 0)}\n',
+        f'BDAT{random_space(rng, 1)}{rng.randrange(100000)}{random_space(rng, 0)}\n',
+        f'BDAT{random_space(rng, 1)}{rng.randrange(100000)}{random_space(rng, 1)}LAST{random_space(rng, 0)}\n'
+    ])
+
+# a few random inserts, deletes and replacements so most lines end up
+# just barely invalid
+def mutate(rng, line):
+    chars = list(line)
+    for _ in range(rng.randint(1, 3)):
+        pos = rng.randint(0, len(chars))
+        op = rng.random()
+        if op < 0.4 or not chars:
+            chars.insert(pos, rng.choice(CORPUS_ALPHABET))
+        elif op < 0.7:
+            del chars[min(pos, len(chars) - 1)]
+        else:
+            chars[min(pos, len(chars) - 1)] = rng.choice(CORPUS_ALPHABET)
+
+    return ''.join(chars)
+
+def generate_corpus(count, seed, seeds):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        line = random_command(rng) if rng.random() < 0.5 else rng.choice(seeds)
+        if rng.random() < 0.6:
+            line = mutate(rng, line)
+        corpus.append(line)
+
+    return corpus
+
+# runs both parsers over the same lines and returns the lines where they
+# disagree along with how many lines were accepted
+def diff_parse(lines):
+    from parse import CMDParser, PathCache
+
+    fast = CMDParser()
+    # a small cache so entries get evicted as well as hit
+    cached = CMDParser(path_cache=PathCache(64))
+    descent = CMDParser(fast=False)
+
+    mismatches = []
+    accepted = 0
+    for line in lines:
+        want = descent.parse(line)
+        accepted += want.status == 0
+
+        for got in (fast.parse(line), cached.parse(line)):
+            if got != want:
+                mismatches.append((line, got, want))
+
+    return mismatches, accepted
+
+def check_parse(args):
+    count = int(args[0]) if len(args) > 0 else DIFF_CORPUS_SIZE
+    seed = int(args[1]) if len(args) > 1 else 0
+
+    with open(PARSE_FIXTURE) as fixture:
+        fixture_lines = fixture.readlines()
+    corpus = fixture_lines + generate_corpus(count, seed, fixture_lines)
+
+    mismatches, accepted = diff_parse(corpus)
+    print(f'{len(corpus)} lines checked, {accepted} accepted, {len(mismatches)} mismatches')
+
+    for line, got, want in mismatches[:20]:
+        print(f'{line!r}\n    fast path: {got}\n    descent:   {want}')
+
+    if mismatches:
+        exit(1)
+
+# ###### path cache ######
+
+# nine in ten lines reuse one of the hot addresses, the rest are one-offs
+def hot_path_traffic(count, hot, seed=0):
+    rng = random.Random(seed)
+    hot_paths = [f'{random_string(rng)}@{random_domain(rng)}.example.com' for _ in range(hot)]
+
+    lines = []
+    for _ in range(count):
+        if rng.random() < 0.9:
+            # skewed so a handful of addresses dominate
+            path = hot_paths[min(int(rng.expovariate(10 / hot)), hot - 1)]
+        else:
+            path = f'{random_string(rng)}@{random_domain(rng)}'
+        lines.append(rng.choice(('MAIL FROM:', 'RCPT TO: ')) + f'<{path}>\n')
+
+    return lines
+
+def bench_path_cache(args):
+    from parse import CMDParser, PathCache
+
+    count = int(args[0]) if len(args) > 0 else CACHE_BENCH_LINES
+    hot = int(args[1]) if len(args) > 1 else CACHE_BENCH_HOT
+    lines = hot_path_traffic(count, hot)
+
+    cache = PathCache()
+    for name, parser in (('no cache', CMDParser()), ('path cache', CMDParser(path_cache=cache))):
+        start = time.perf_counter()
+        for line in lines:
+            parser.parse(line)
+        elapsed = time.perf_counter() - start
+
+        print(f'{name:>12}: {count / elapsed:.0f} lines/sec')
+
+    print(f'cache: {cache.hits} hits, {cache.misses} misses, {cache.hit_rate():.1%} hit rate')
+
+# ###### bulk parsing ######
+
+# the parse.py driver as it was, one parse and two prints per line
+def replay_per_line(parser, lines, out):
+    for usrinput in lines:
+        print(usrinput[:-1] if usrinput[-1] == '\n' else usrinput, file=out)
+        result = parser.parse(usrinput)
+
+        if result.status == 0:
+            print('250 OK', file=out)
+        else:
+            if result.bad_token[-3:] == 'cmd':
+                print('500 Syntax error: command unrecognized', file=out)
+            else:
+                print('501 Syntax error in parameters or arguments', file=out)
+
+# the same output built from parse_many a batch at a time
+def replay_batched(parser, lines, out):
+    from parse import REPLIES, BATCH_SIZE
+
+    for start in range(0, len(lines), BATCH_SIZE):
+        chunk = lines[start:start+BATCH_SIZE]
+        for batch in parser.parse_many(chunk, len(chunk)):
+            parts = []
+            for usrinput, err in zip(chunk, batch.error):
+                parts.append(usrinput[:-1] if usrinput[-1] == '\n' else usrinput)
+                parts.append(REPLIES[err])
+            parts.append('')
+
+            out.write('\n'.join(parts))
+
+def bench_parse_many(args):
+    from parse import CMDParser, OUTBUF
+
+    count = int(args[0]) if args else TRANSCRIPT_LINES
+
+    with open(PARSE_FIXTURE) as fixture:
+        fixture_lines = fixture.readlines()
+    # lines read from a file are never empty, the generated ones can be
+    lines = [line for line in generate_corpus(count, 0, fixture_lines) if line != '']
+    count = len(lines)
+    parser = CMDParser()
+
+    for name, replay, buffering in (('per-line', replay_per_line, -1), ('parse_many', replay_batched, OUTBUF)):
+        with open(os.devnull, 'w', buffering=buffering) as out:
+            start = time.perf_counter()
+            replay(parser, lines, out)
+            elapsed = time.perf_counter() - start
+
+        print(f'{name:>12}: {count} lines in {elapsed:.2f}s, {count / elapsed:.0f} lines/sec')
+
+BENCHMARKS = {
+    'server':bench_server,
+    'load':bench_load,
+    'reuse':bench_reuse,
+    'pipeline':bench_pipeline,
+    'bdat':bench_bdat,
+    'senddata':bench_send_data,
+    'fanout':bench_fanout,
+    'commit':bench_commit,
+    'handles':bench_handles,
+    'reader':bench_reader,
+    'replay':bench_replay,
+    'parse':bench_parse,
+    'parsediff':check_parse,
+    'pathcache':bench_path_cache,
+    'parsemany':bench_parse_many
+}
+
+if __name__ == "__main__":
+    if len(argv) < 2 or argv[1] not in BENCHMARKS:
+        print('usage: python bench.py <' + '|'.join(BENCHMARKS) + '> [args...]')
+        exit(1)
+    else:
+        BENCHMARKS[argv[1]](argv[2:])
@@ -0,0 +1,131 @@
+# buffered line framing for anything reading SMTP off a socket
+#
+# a single recv can hold several commands or only part of one, so bytes are
+# collected in one bytearray and handed back a line at a time. the scan for
+# '\n' resumes where the last one stopped, so a long line that trickles in
+# over many reads is only ever looked at once
+#
+# a line is never held back past max_line bytes. once that much is buffered
+# with no '\n' in it, it's handed out in max_line pieces, which the reader
+# can tell apart by the missing '\n' on the end
+
+from collections import namedtuple
+
+BUFSIZE = 1024
+# longest line buffered before it's handed out in pieces
+MAX_LINE = 64 * 1024
+
+# one whole SMTP reply, text holds every line of it without the code. code
+# is '' when the last line isn't <code><whitespace><text>
+Reply = namedtuple('Reply', ['code', 'text'])
+
+class LineBuffer():
+    def __init__(self, bufsize=BUFSIZE, max_line=MAX_LINE):
+        self.buf = bytearray()
+        self.max_line = max_line
+        self.start = 0 # first byte not yet handed out
+        self.scanned = 0 # everything before this has been checked for '\n'
+
+        # scratch space recv_into reads into, reused for every read
+        self._chunk = bytearray(bufsize)
+        self._chunkview = memoryview(self._chunk)
+
+    # reads once from a blocking socket into the buffer
+    # returns the number of bytes read, 0 means the peer closed the connection
+    def fill(self, sock):
+        n = sock.recv_into(self._chunk)
+        if n > 0:
+            self.feed(self._chunkview[:n])
+
+        return n
+
+    # appends bytes that were read some other way
+    def feed(self, data):
+        self._compact()
+        self.buf += data
+
+    # returns the next complete line including its '\n', or None when
+    # more input is needed first. a line that grew past max_line comes back
+    # max_line bytes at a time without one
+    def readline(self):
+        end = self.buf.find(b'\n', max(self.start, self.scanned))
+        if end == -1:
+            if len(self.buf) - self.start >= self.max_line:
+                return self.read(self.max_line)
+
+            self.scanned = len(self.buf)
+            return None
+
+        line = bytes(self.buf[self.start:end+1])
+        self.start = end + 1
+        self.scanned = self.start
+
+        return line
+
+    # returns up to n buffered bytes as they are, with no looking for '\n',
+    # or None when nothing is buffered
+    def read(self, n):
+        if self.start == len(self.buf):
+            return None
+
+        end = min(self.start + n, len(self.buf))
+        data = bytes(self.buf[self.start:end])
+        self.start = end
+        self.scanned = max(self.scanned, self.start)
+
+        return data
+
+    # number of buffered bytes that have not been handed out yet
+    def pending(self):
+        return len(self.buf) - self.start
+
+    # drops everything already handed out, but only once that is at least
+    # half the buffer so the memmove cost stays amortized over the reads
+    def _compact(self):
+        if self.start > 0 and self.start >= len(self.buf) // 2:
+            del self.buf[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+
+# the client side, handing out whole replies instead of lines
+#
+# a multi-line reply is <code>-<text> lines ending with a <code> <text> line,
+# and nothing of it is handed out until that last line is in, however the
+# reply was split across reads. several pipelined replies that came in one
+# read are handed out one per call. the same max_line cap holds, a reply
+# still unfinished at that size is handed out as it is with no code
+class ReplyBuffer(LineBuffer):
+    # returns the next complete Reply, or None when more input is needed first
+    def reply(self):
+        # replies are a few short lines, so each call just looks from the
+        # start of the reply again
+        pos = self.start
+        end = self.buf.find(b'\n', pos)
+        while end != -1 and self.buf[pos+3:pos+4] == b'-':
+            pos = end + 1
+            end = self.buf.find(b'\n', pos)
+
+        if end == -1:
+            if len(self.buf) - self.start < self.max_line:
+                return None
+
+            lines = bytes(self.buf[self.start:]).decode(errors='replace').split('\n')
+            self.start = len(self.buf)
+            self.scanned = self.start
+
+            return Reply('', [line[4:] for line in lines])
+
+        # a byte that isn't utf-8 comes through as U+FFFD instead of raising
+        lines = bytes(self.buf[self.start:end+1]).decode(errors='replace').split('\n')[:-1]
+        self.start = end + 1
+        self.scanned = self.start
+
+        # recieved ack code must have the correct number
+        # in addition to being a well-formed message
+        # ie must follow <code><whitespace><*+><CRLF>
+        last = lines[-1]
+        code = ''
+        if last[3:4] in (' ', '\t') and last[4:] != '':
+            code = last[:3]
+
+        return Reply(code, [line[4:] for line in lines])
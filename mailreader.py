@@ -0,0 +1,165 @@
+# read side for the flat forward/ mailbox files
+#
+# a mailbox file is memory mapped and never read into Python strings. every
+# message starts with a 'From: <' line, the same boundary SMTP2 goes by, so
+# a message is everything from one of those lines up to the next one. a body
+# line that itself starts with 'From: <' is taken as a boundary too, the same
+# as it is everywhere else
+#
+# messages come back as memoryview slices of the map, so nothing is copied
+# until the caller asks for bytes. every view has to be released (or dropped)
+# before close(), a map with views still on it can't be closed
+#
+# usage: python mailreader.py <mailbox file> [index]
+#   prints how many messages the mailbox holds, building or refreshing the
+#   sidecar index when index is given
+
+import mmap
+import os
+import struct
+from array import array
+from sys import argv
+
+BOUNDARY = b'\nFrom: <'
+# the sidecar index sits in a directory next to the mailbox, as
+# .idx/<mailbox>. a mailbox name can't start with '.', so no delivery can
+# ever land on an index or be taken for one
+INDEX_DIR = '.idx'
+# sidecar header, the size of the mailbox when the index was written
+INDEX_HEADER = struct.Struct('<Q')
+
+class MailboxReader():
+    # with use_index the message offsets are kept in a sidecar file, so
+    # opening a big mailbox again only has to scan what was appended since
+    def __init__(self, path, use_index=False):
+        self.path = path
+        self.use_index = use_index
+
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # an empty file can't be mapped, it just has no messages
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else None
+        self.view = memoryview(self.map) if self.map is not None else None
+
+        # where every message starts, only worked out once something needs it
+        self._offsets = None
+
+    # yields every message in order, scanning only as far as the loop gets
+    # when the offsets aren't known yet
+    def __iter__(self):
+        if self._offsets is not None:
+            for i in range(len(self._offsets)):
+                yield self._message(i)
+            return
+
+        start = None
+        for offset in self._scan(0):
+            if start is not None:
+                yield self.view[start:offset]
+            start = offset
+
+        if start is not None:
+            yield self.view[start:self.size]
+
+    def __len__(self):
+        return len(self.offsets())
+
+    # message i as a memoryview, negative i counts back from the newest
+    def __getitem__(self, i):
+        offsets = self.offsets()
+        if i < 0:
+            i += len(offsets)
+        if i < 0 or i >= len(offsets):
+            raise IndexError('message index out of range')
+
+        return self._message(i)
+
+    # array of the offset every message starts at
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = self._load_index() if self.use_index else array('Q', self._scan(0))
+
+        return self._offsets
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.map.close()
+            self.view = None
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _message(self, i):
+        offsets = self._offsets
+        end = offsets[i + 1] if i + 1 < len(offsets) else self.size
+        return self.view[offsets[i]:end]
+
+    # offsets of every message starting at or after start, which has to be
+    # the start of a message itself. one pass of find over the map
+    def _scan(self, start):
+        pos = start
+        while pos < self.size:
+            yield pos
+
+            nxt = self.map.find(BOUNDARY, pos)
+            if nxt == -1:
+                return
+            pos = nxt + 1
+
+    # reads the sidecar index, rescans whatever the mailbox gained since it
+    # was written and saves it again if anything changed. a mailbox that got
+    # shorter was rewritten, so the index is thrown away and built fresh
+    def _load_index(self):
+        offsets = array('Q')
+        covered = 0
+        try:
+            with open(self._index_path(), 'rb') as f:
+                covered = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))[0]
+                offsets.frombytes(f.read())
+        except (FileNotFoundError, struct.error, ValueError):
+            offsets = array('Q')
+            covered = 0
+
+        if covered > self.size:
+            offsets = array('Q')
+            covered = 0
+
+        if covered == self.size and (len(offsets) > 0 or self.size == 0):
+            return offsets
+
+        # the last message may have still been coming in when the index was
+        # written, so the scan starts over from it
+        start = offsets.pop() if len(offsets) > 0 else 0
+        offsets.extend(self._scan(start))
+
+        self._save_index(offsets)
+
+        return offsets
+
+    def _save_index(self, offsets):
+        path = self._index_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(INDEX_HEADER.pack(self.size))
+            f.write(offsets.tobytes())
+        os.replace(tmp, path)
+
+    def _index_path(self):
+        head, name = os.path.split(self.path)
+        return os.path.join(head, INDEX_DIR, name)
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        print('usage: python mailreader.py <mailbox file> [index]')
+        exit(1)
+    else:
+        with MailboxReader(argv[1], len(argv) > 2 and argv[2] == 'index') as reader:
+            print(len(reader))
@@ -0,0 +1,641 @@
+# storage side of the mail server
+#
+# message bodies are streamed into a spool file while DATA is coming in and
+# only copied out to a store once the whole message is accepted, so a session
+# never holds more than one line of a message in memory
+#
+# a store is anything with deliver(spool, names) and close(). deliver returns
+# None once the message is written, the stores here do that through write(),
+# which hands back the paths it wrote to. FlatStore appends to one
+# forward/<name> file per mailbox like always, optionally spread over hashed
+# subdirectories, SegmentStore keeps each mailbox
+# as size capped segment files plus an index of where every message sits, and
+# BlobStore writes every body once and gives mailboxes references to it.
+# a DeliveryQueue can sit in front of any of them to take the writes off the
+# session and fsync them in batches
+
+import fcntl
+import hashlib
+import os
+import queue
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from sys import stderr
+
+# largest message body accepted, in bytes
+MAX_MSG_SIZE = 32 * 1024 * 1024
+# where spool files are created, None means the system temp dir
+SPOOL_DIR = None
+# bytes moved per copy call when delivering out of the spool
+COPY_CHUNK = 1024 * 1024
+
+FORWARD_DIR = 'forward'
+# open forward/ files a FlatStore keeps around, 0 opens and closes every time
+HANDLE_CACHE_SIZE = 256
+# levels of two hex digit subdirectories a sharded FlatStore puts mailboxes
+# under, forward/ab/cd/<name> with 2. 0 is the plain flat layout
+SHARD_DEPTH = 2
+
+# where a SegmentStore keeps its mailboxes
+STORE_DIR = 'store'
+# a new segment is started once a message would take the current one past this
+SEGMENT_SIZE = 64 * 1024 * 1024
+# one index entry per message, (segment, offset, length, timestamp)
+INDEX_RECORD = struct.Struct('<IQQd')
+
+# where a BlobStore keeps message bodies, under its root. the leading '.'
+# keeps it apart from the mailboxes, valid_name refuses it as one
+BLOB_DIR = '.blobs'
+# one BlobStore reference per message, (sha256 digest, length, timestamp)
+BLOB_RECORD = struct.Struct('<32sQd')
+
+# a DeliveryQueue commits whatever is queued as soon as its writer is free,
+# capped at this many messages, and never spends more than
+# GROUP_COMMIT_INTERVAL seconds gathering one batch
+GROUP_COMMIT_SIZE = 256
+GROUP_COMMIT_INTERVAL = 0.005
+
+# mailbox names come straight from RCPT TO, and the parser lets a domain
+# hold '/'. a name is only used as a single file or directory name under a
+# store's root, so anything that could step outside it or hide in it is
+# refused by every store
+def valid_name(name):
+    return (name != '' and name[0] != '.' and '/' not in name and os.sep not in name
+            and (os.altsep is None or os.altsep not in name) and '\0' not in name)
+
+def check_name(name):
+    if not valid_name(name):
+        raise ValueError(f'mailbox name not allowed: {name!r}')
+
+# holds one message body on disk while it is being received
+class Spool():
+    def __init__(self, max_size=MAX_MSG_SIZE, spool_dir=SPOOL_DIR):
+        self.file = tempfile.TemporaryFile(dir=spool_dir)
+        self.size = 0
+        self.max_size = max_size
+        self.overflow = False
+
+    # appends raw bytes, anything past the size limit is dropped and the
+    # spool is marked so the message can be refused once DATA ends
+    def write(self, data):
+        if self.overflow:
+            return
+
+        if self.size + len(data) > self.max_size:
+            self.overflow = True
+            return
+
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+# one flat file per mailbox, each message appended to the end of it
+# with shard_depth > 0 the file sits under subdirectories picked by a hash of
+# its name, so no single directory ends up with millions of entries
+class FlatStore():
+    def __init__(self, forward_dir=FORWARD_DIR, cache_size=HANDLE_CACHE_SIZE, shard_depth=0):
+        self.forward_dir = forward_dir
+        self.shard_depth = shard_depth
+        self.handles = HandleCache(cache_size)
+
+    def deliver(self, spool, names):
+        self.write(spool, names)
+
+    # copies the spooled message onto the end of forward/<name> for every name
+    def write(self, spool, names):
+        spool.file.flush()
+
+        paths = []
+        for name in names:
+            path = self.path(name)
+            # only a sharded store makes directories, and only its shard levels
+            fd = self.handles.open(path, self.forward_dir if self.shard_depth > 0 else None)
+            try:
+                # the lock keeps the message in one piece against any other
+                # FlatStore appending to the same mailbox, SMTP1.py and
+                # Server.py sharing forward/ say
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    _append_range(spool.file, fd, spool.size)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                self.handles.release(path, fd)
+            paths.append(path)
+
+        return paths
+
+    # where the mailbox file for name lives, whether it exists yet or not
+    def path(self, name):
+        check_name(name)
+        return shard_path(self.forward_dir, name, self.shard_depth)
+
+    def close(self):
+        self.handles.close()
+
+# path of the mailbox name under root, depth levels of subdirectories deep
+def shard_path(root, name, depth):
+    if depth <= 0:
+        return os.path.join(root, name)
+
+    digest = hashlib.sha1(name.encode()).hexdigest()
+    return os.path.join(root, *(digest[2*i:2*i+2] for i in range(depth)), name)
+
+# bounded LRU of open write descriptors keyed on path, so mailboxes that get
+# mail all the time aren't opened and closed for every message
+# writes go straight to the descriptor with nothing buffered in between, so
+# there is never anything to flush and evicting one is just a close
+# a file renamed or removed while its descriptor is cached keeps getting
+# written through the old descriptor, so anything moving mailboxes around
+# has to close() the cache first
+class HandleCache():
+    def __init__(self, size=HANDLE_CACHE_SIZE):
+        self.size = size
+        self.fds = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # returns a descriptor open for appending to path, creating the file if
+    # needed. with root given, missing directories between root and the file
+    # are made as well, root itself has to be there already
+    def open(self, path, root=None):
+        fd = self.fds.pop(path, None)
+        if fd is not None:
+            self.hits += 1
+            return fd
+
+        self.misses += 1
+        try:
+            return os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            if root is None:
+                raise
+
+            d = root
+            for part in os.path.relpath(os.path.dirname(path), root).split(os.sep):
+                d = os.path.join(d, part)
+                try:
+                    os.mkdir(d)
+                except FileExistsError:
+                    pass
+            return os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    # hands a descriptor from open() back, it stays open as the most
+    # recently used one unless the cache is full
+    def release(self, path, fd):
+        if self.size <= 0:
+            os.close(fd)
+            return
+
+        self.fds[path] = fd
+        if len(self.fds) > self.size:
+            _, old = self.fds.popitem(last=False)
+            os.close(old)
+            self.evictions += 1
+
+    def open_files(self):
+        return len(self.fds)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def close(self):
+        while self.fds:
+            os.close(self.fds.popitem()[1])
+
+# the read side shared by the indexed stores. every mailbox is a directory
+# holding an index file of fixed size records, one per message in delivery
+# order with the delivery timestamp last. with fixed size records counting is
+# a stat, the nth message is one read of the index plus one of wherever the
+# record points, and a delivery time is found by binary search
+class _IndexedStore():
+    RECORD = None
+    INDEX_NAME = 'index'
+
+    def __init__(self, root):
+        self.root = root
+
+    def deliver(self, spool, names):
+        self.write(spool, names)
+
+    def close(self):
+        pass
+
+    # number of messages in a mailbox
+    def count(self, name):
+        try:
+            return os.stat(self._index_path(name)).st_size // self.RECORD.size
+        except FileNotFoundError:
+            return 0
+
+    # index record of message i, negative i counts back from the newest
+    def entry(self, name, i):
+        return self.entries(name, i, 1)[0]
+
+    # up to n index records starting at message i
+    def entries(self, name, i, n):
+        total = self.count(name)
+        if i < 0:
+            i += total
+        if i < 0 or i >= total:
+            raise IndexError('message index out of range')
+
+        n = min(n, total - i)
+        with open(self._index_path(name), 'rb') as index:
+            data = os.pread(index.fileno(), n * self.RECORD.size, i * self.RECORD.size)
+
+        return list(self.RECORD.iter_unpack(data))
+
+    # the bytes of message i
+    def fetch(self, name, i):
+        return self._read(name, self.entry(name, i))
+
+    # the newest n messages, oldest first
+    def tail(self, name, n):
+        total = self.count(name)
+        if n <= 0 or total == 0:
+            return []
+
+        start = max(0, total - n)
+
+        return [self._read(name, entry) for entry in self.entries(name, start, n)]
+
+    # index of the first message delivered at or after timestamp, count() if
+    # there are none. assumes the clock only ever moved forward
+    def since(self, name, timestamp):
+        lo = 0
+        hi = self.count(name)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(name, mid)[-1] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    # opens a mailbox's index for appending, creating the mailbox if needed
+    # what's left of a record torn by a crash is dropped first
+    def _open_index(self, name):
+        check_name(name)
+        os.makedirs(os.path.join(self.root, name), exist_ok=True)
+
+        index = os.open(self._index_path(name), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        size = os.fstat(index).st_size
+        if size % self.RECORD.size != 0:
+            os.ftruncate(index, size - size % self.RECORD.size)
+
+        return index
+
+    def _index_path(self, name):
+        return os.path.join(self.root, name, self.INDEX_NAME)
+
+# append-only store, every mailbox is a directory of numbered segment files
+# that are never rewritten plus an index of (segment, offset, length,
+# timestamp) records. a message's bytes are written before its record, so the
+# index only ever points at data that made it to the segment
+class SegmentStore(_IndexedStore):
+    RECORD = INDEX_RECORD
+
+    def __init__(self, root=STORE_DIR, segment_size=SEGMENT_SIZE):
+        _IndexedStore.__init__(self, root)
+        self.segment_size = segment_size
+
+    def write(self, spool, names):
+        spool.file.flush()
+        now = time.time()
+
+        paths = []
+        for name in names:
+            paths.extend(self._append(spool, name, now))
+
+        return paths
+
+    # returns the segment and index it wrote to
+    def _append(self, spool, name, now):
+        index = self._open_index(name)
+        try:
+            # the last record says which segment is current and where it ends
+            end = os.fstat(index).st_size
+            if end > 0:
+                segment, offset, length, _ = INDEX_RECORD.unpack(
+                    os.pread(index, INDEX_RECORD.size, end - INDEX_RECORD.size))
+                offset += length
+            else:
+                segment, offset = 0, 0
+
+            if offset > 0 and offset + spool.size > self.segment_size:
+                segment += 1
+                offset = 0
+
+            fd = os.open(self._segment_path(name, segment), os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                _copy_range(spool.file, fd, spool.size, offset)
+            finally:
+                os.close(fd)
+
+            os.write(index, INDEX_RECORD.pack(segment, offset, spool.size, now))
+        finally:
+            os.close(index)
+
+        return [self._segment_path(name, segment), self._index_path(name)]
+
+    def _read(self, name, entry):
+        segment, offset, length, _ = entry
+
+        with open(self._segment_path(name, segment), 'rb') as f:
+            return os.pread(f.fileno(), length, offset)
+
+    def _segment_path(self, name, segment):
+        return os.path.join(self.root, name, f'{segment:08d}.seg')
+
+# single instance store, a message body is written once under .blobs/ named
+# by its sha256 and every mailbox it goes to only gets a (digest, length,
+# timestamp) record pointing at it. a delivery costs one copy of the body
+# plus one record per recipient rather than a copy per recipient, and a body
+# that was already stored by an earlier delivery isn't written at all
+#
+# blobs are moved into place whole, so a record never points at a partial one
+class BlobStore(_IndexedStore):
+    RECORD = BLOB_RECORD
+    INDEX_NAME = 'refs'
+
+    def __init__(self, root=STORE_DIR):
+        _IndexedStore.__init__(self, root)
+        self.blob_dir = os.path.join(root, BLOB_DIR)
+
+    def write(self, spool, names):
+        spool.file.flush()
+        now = time.time()
+
+        # every name is checked before the body goes in, so a refused
+        # delivery leaves no blob behind
+        for name in names:
+            check_name(name)
+
+        digest = self._put(spool)
+        record = BLOB_RECORD.pack(digest, spool.size, now)
+
+        paths = [self._blob_path(digest)]
+        for name in names:
+            index = self._open_index(name)
+            try:
+                os.write(index, record)
+            finally:
+                os.close(index)
+            paths.append(self._index_path(name))
+
+        return paths
+
+    # stores the spooled body unless it is already there, returns its digest
+    def _put(self, spool):
+        digest = _file_digest(spool.file, spool.size)
+        path = self._blob_path(digest)
+        if os.path.exists(path):
+            return digest
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            os.fchmod(fd, 0o644)
+            _copy_range(spool.file, fd, spool.size, 0)
+        finally:
+            os.close(fd)
+        os.replace(tmp, path)
+
+        return digest
+
+    def _read(self, name, entry):
+        digest, length, _ = entry
+
+        with open(self._blob_path(digest), 'rb') as f:
+            return os.pread(f.fileno(), length, 0)
+
+    # .blobs/<first two hex digits>/<hex digest>, so no one directory gets huge
+    def _blob_path(self, digest):
+        digest = digest.hex()
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+# write-behind group commit in front of a store
+#
+# deliver() hands the spooled message to a writer thread and returns at once.
+# the writer takes messages in batches, writes each one to the store in the
+# order they came in, then fsyncs every file and directory the batch touched
+# one time, so a mailbox that got 50 messages in a batch is synced once
+#
+# the writer never sits waiting for a batch to fill. it takes everything
+# already queued and commits it, and whatever turns up while that fsync runs
+# is the next batch. a lone message goes out at once, and under load the
+# batches grow on their own
+#
+# durability contract:
+#   strict=False  deliver() returns None and the 250 goes out straight away.
+#                 the message is on disk once the batch ahead of it and its
+#                 own have been written, a crash in that window loses
+#                 messages that were already acknowledged
+#   strict=True   deliver() returns a Future that is done once the batch
+#                 holding the message has been fsynced, and the session holds
+#                 its 250 back until then. a message that was acknowledged is
+#                 on disk. if the write fails the Future carries the error and
+#                 the client gets a 451 instead
+class DeliveryQueue():
+    def __init__(self, store, strict=False, batch_size=GROUP_COMMIT_SIZE, interval=GROUP_COMMIT_INTERVAL):
+        self.store = store
+        self.strict = strict
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.pending = queue.Queue()
+
+        self.batches = 0
+        self.messages = 0
+
+        self.writer = threading.Thread(target=self._write_behind, daemon=True)
+        self.writer.start()
+
+    # queues the message, the spool can be closed as soon as this returns
+    def deliver(self, spool, names):
+        spool.file.flush()
+
+        # the spool file is already unlinked, a second descriptor keeps the
+        # data around for the writer after the session closes its own
+        handoff = _Handoff(os.fdopen(os.dup(spool.file.fileno()), 'rb'), spool.size)
+        done = Future() if self.strict else None
+
+        self.pending.put((handoff, list(names), done))
+
+        return done
+
+    # writes out whatever is still queued and stops the writer. the writer
+    # is a daemon thread, anything still queued when the process exits
+    # without this is lost
+    def close(self):
+        self.pending.put(None)
+        self.writer.join()
+        self.store.close()
+
+    def _write_behind(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+
+            # take whatever else is already queued, without waiting on more
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            stop = False
+            while len(batch) < self.batch_size and time.monotonic() < deadline:
+                try:
+                    item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._commit(batch)
+
+            if stop:
+                return
+
+    def _commit(self, batch):
+        paths = set()
+        failed = {}
+        for handoff, names, done in batch:
+            try:
+                paths.update(self.store.write(handoff, names))
+            # a name the store won't take fails only its own message
+            except (OSError, ValueError) as e:
+                failed[id(handoff)] = e
+            finally:
+                handoff.file.close()
+
+        err = None
+        try:
+            _fsync_paths(paths)
+        except OSError as e:
+            err = e
+
+        self.batches += 1
+        self.messages += len(batch)
+
+        for handoff, names, done in batch:
+            e = failed.get(id(handoff), err)
+            if done is not None:
+                if e is None:
+                    done.set_result(True)
+                else:
+                    done.set_exception(e)
+            elif e is not None:
+                print('delivery to ' + ', '.join(names) + ' failed: ' + str(e), file=stderr)
+
+# what a DeliveryQueue passes to the store in place of the session's spool
+class _Handoff():
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+
+# fsyncs every file in paths and then the directories holding them and the
+# ones above those, so newly created files and mailbox or blob directories
+# can be found again after a crash
+def _fsync_paths(paths):
+    dirs = set()
+    for path in paths:
+        _fsync(path)
+
+        parent = os.path.dirname(path)
+        dirs.add(parent or '.')
+        dirs.add(os.path.dirname(parent) or '.')
+
+    for d in dirs:
+        _fsync(d)
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# sha256 of the first size bytes of an open file, read in COPY_CHUNK pieces
+def _file_digest(f, size):
+    h = hashlib.sha256()
+    done = 0
+    while done < size:
+        data = os.pread(f.fileno(), min(COPY_CHUNK, size - done), done)
+        if data == b'':
+            break
+        h.update(data)
+        done += len(data)
+
+    return h.digest()
+
+# every store that can be picked by name, for Server.py and SMTP1.py
+STORES = {
+    'flat':FlatStore,
+    'sharded':lambda: FlatStore(shard_depth=SHARD_DEPTH),
+    'segments':SegmentStore,
+    'blobs':BlobStore
+}
+
+# appends the first size bytes of src to an O_APPEND descriptor, so every
+# write lands at the end of the file however many processes are writing to
+# it. copy_file_range and sendfile both refuse O_APPEND targets, so this is
+# a plain read and write a COPY_CHUNK at a time
+def _append_range(src, dst_fd, size):
+    src_fd = src.fileno()
+    copied = 0
+    while copied < size:
+        data = os.pread(src_fd, min(COPY_CHUNK, size - copied), copied)
+        if data == b'':
+            break
+
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(dst_fd, view):]
+        copied += len(data)
+
+# copies size bytes from the start of src onto dst_fd at offset, in the kernel
+# when it can. copy_file_range needs an explicit offset since it refuses
+# O_APPEND targets, sendfile is tried next and a plain buffered copy last
+def _copy_range(src, dst_fd, size, offset):
+    src_fd = src.fileno()
+    copied = 0
+
+    try:
+        while copied < size:
+            n = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK, size - copied), copied, offset + copied)
+            if n == 0:
+                break
+            copied += n
+        return
+    except (AttributeError, OSError):
+        pass
+
+    os.lseek(dst_fd, offset + copied, os.SEEK_SET)
+    try:
+        while copied < size:
+            n = os.sendfile(dst_fd, src_fd, copied, min(COPY_CHUNK, size - copied))
+            if n == 0:
+                break
+            copied += n
+        return
+    except (AttributeError, OSError):
+        pass
+
+    src.seek(copied)
+    with os.fdopen(os.dup(dst_fd), 'wb') as dst:
+        dst.seek(offset + copied)
+        shutil.copyfileobj(src, dst, COPY_CHUNK)
@@ -0,0 +1,86 @@
+# moves an existing forward/ directory between the flat layout and the
+# sharded one a FlatStore with shard_depth > 0 writes to
+# usage: python migrate.py <forward dir> <shard depth>
+#
+# depth 2 turns forward/<name> into forward/ab/cd/<name>, depth 0 flattens it
+# back out. the server must not be running while this goes, since a running
+# FlatStore keeps descriptors on the files it has open
+#
+# files are moved in two passes through a staging directory, with the
+# emptied shard directories removed in between, so a mailbox named like a
+# shard directory can't get in the way. running it again after an
+# interruption picks up where it stopped
+
+import os
+import shutil
+from sys import argv
+from mailstore import shard_path
+from mailreader import INDEX_DIR
+
+# names can't start with '.', so this never clashes with a mailbox
+STAGING = '.migrate'
+
+def migrate(forward_dir, depth):
+    staging = os.path.join(forward_dir, STAGING)
+    os.makedirs(staging, exist_ok=True)
+
+    # sidecar indexes are a cache tied to where a mailbox sits, they'd be
+    # stale after the move, so they're dropped and built again on next use
+    for dirpath, dirs, _ in os.walk(forward_dir):
+        if INDEX_DIR in dirs:
+            shutil.rmtree(os.path.join(dirpath, INDEX_DIR))
+            dirs.remove(INDEX_DIR)
+
+    # first pass, everything not already where it belongs goes to staging.
+    # nothing starting with '.' is a mailbox, staging included
+    for dirpath, dirs, files in os.walk(forward_dir):
+        dirs[:] = [d for d in dirs if d[0] != '.']
+
+        for name in files:
+            if name[0] == '.':
+                continue
+
+            path = os.path.join(dirpath, name)
+            if path != shard_path(forward_dir, name, depth):
+                _move(path, os.path.join(staging, name))
+
+    # the shard directories the first pass emptied go before anything comes
+    # back out, a mailbox named like one (ab, say) needs its place
+    _remove_empty(forward_dir, staging)
+
+    # second pass, out of staging into the new layout
+    moved = 0
+    for name in os.listdir(staging):
+        target = shard_path(forward_dir, name, depth)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        _move(os.path.join(staging, name), target)
+        moved += 1
+
+    _remove_empty(forward_dir)
+
+    return moved
+
+# clears out empty directories under forward_dir, deepest first, leaving keep
+def _remove_empty(forward_dir, keep=None):
+    for dirpath, _, _ in os.walk(forward_dir, topdown=False):
+        if dirpath != forward_dir and dirpath != keep and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+# renames src to dst, if dst is already there (the same mailbox turned up in
+# both layouts) src is appended to it instead
+def _move(src, dst):
+    if not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+
+    with open(src, 'rb') as fsrc, open(dst, 'ab') as fdst:
+        shutil.copyfileobj(fsrc, fdst)
+    os.remove(src)
+
+if __name__ == "__main__":
+    if len(argv) < 3:
+        print('usage: python migrate.py <forward dir> <shard depth>')
+        exit(1)
+    else:
+        moved = migrate(argv[1], int(argv[2]))
+        print(f'moved {moved} mailboxes')
@@ -0,0 +1,214 @@
+# on-disk queue of outgoing messages waiting to be sent, or sent again
+#
+# a queue is a directory with two files. journal holds every message ever
+# submitted, appended and never rewritten. index holds one fixed size record
+# per message, (journal offset, length, attempts, state, next attempt time),
+# and is the only thing changed after a submit, a record at a time in place
+#
+# pending messages sit in a heap ordered on their next attempt time, so each
+# tick only touches what's due. the index is read through once when the queue
+# is opened to build the heap back up, so messages left over from before a
+# restart are picked up where they were. only one process may have a queue
+# open at a time
+#
+# a message that fails with a 4xx reply, or never got a reply at all, is
+# tried again after RETRY_BASE seconds, doubling every attempt up to
+# RETRY_MAX. a 5xx reply or MAX_ATTEMPTS tries and it's given up on
+#
+# usage: python outqueue.py <queue dir> [run|status]
+#   run sends everything pending, waiting out the retries, until nothing is
+#   left. status prints how many messages are in each state
+
+import asyncio
+import heapq
+import json
+import os
+import struct
+import time
+from sys import argv
+
+OUTQUEUE_DIR = 'outqueue'
+# one index record per message, (journal offset, length, attempts, state,
+# next attempt time)
+QUEUE_RECORD = struct.Struct('<QQIBd')
+
+PENDING = 0
+SENT = 1
+FAILED = 2
+STATE_NAMES = ['pending', 'sent', 'failed']
+
+# seconds before the first retry, doubled for every one after it
+RETRY_BASE = 1.0
+RETRY_MAX = 3600.0
+MAX_ATTEMPTS = 10
+# most messages a tick sends at once
+TICK_BATCH = 256
+
+class OutboundQueue():
+    # fsync makes every submit and state change wait for the disk, without it
+    # a queue survives the client going down but not the machine
+    def __init__(self, root=OUTQUEUE_DIR, fsync=False):
+        self.root = root
+        self.fsync = fsync
+        os.makedirs(root, exist_ok=True)
+
+        self.journal = os.open(os.path.join(root, 'journal'), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self.index = os.open(os.path.join(root, 'index'), os.O_RDWR | os.O_CREAT, 0o644)
+
+        # what's left of a record torn by a crash is dropped
+        size = os.fstat(self.index).st_size
+        if size % QUEUE_RECORD.size != 0:
+            size -= size % QUEUE_RECORD.size
+            os.ftruncate(self.index, size)
+        self.count = size // QUEUE_RECORD.size
+
+        # (next attempt time, message number) for every pending message
+        self.heap = []
+        self.states = [0, 0, 0]
+        for i, (_, _, _, state, next_at) in enumerate(QUEUE_RECORD.iter_unpack(self._read_index())):
+            self.states[state] += 1
+            if state == PENDING:
+                self.heap.append((next_at, i))
+        heapq.heapify(self.heap)
+
+    # adds a message for host:port, message being (sender, recipients,
+    # subject, body) as for Client.ClientLoop.queue. returns its number
+    def submit(self, host, port, message, now=None):
+        now = time.time() if now is None else now
+        payload = json.dumps([host, port, *message]).encode()
+
+        # the message goes in the journal before its record, so the index only
+        # ever points at data that made it there
+        offset = os.lseek(self.journal, 0, os.SEEK_END)
+        _write_all(self.journal, payload)
+        if self.fsync:
+            os.fsync(self.journal)
+
+        i = self.count
+        self._write_entry(i, (offset, len(payload), 0, PENDING, now))
+        self.count += 1
+        self.states[PENDING] += 1
+        heapq.heappush(self.heap, (now, i))
+
+        return i
+
+    # index record of message i
+    def entry(self, i):
+        return QUEUE_RECORD.unpack(os.pread(self.index, QUEUE_RECORD.size, i * QUEUE_RECORD.size))
+
+    # host, port and message tuple of message i
+    def message(self, i):
+        offset, length, _, _, _ = self.entry(i)
+        host, port, *message = json.loads(os.pread(self.journal, length, offset))
+
+        return host, port, tuple(message)
+
+    def pending(self):
+        return len(self.heap)
+
+    # when the soonest pending message is due, None when nothing is pending
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
+
+    # takes up to limit messages due by now off the heap, they have to be
+    # handed back through record()
+    def due(self, now=None, limit=TICK_BATCH):
+        now = time.time() if now is None else now
+
+        taken = []
+        while self.heap and self.heap[0][0] <= now and len(taken) < limit:
+            taken.append(heapq.heappop(self.heap)[1])
+
+        return taken
+
+    # stores how an attempt at message i went, code being the reply code it
+    # ended with ('' for no reply), and schedules the next try if there is one
+    def record(self, i, code, now=None):
+        now = time.time() if now is None else now
+        offset, length, attempts, state, next_at = self.entry(i)
+        attempts += 1
+
+        if code == '250':
+            state = SENT
+        elif code[:1] == '5' or attempts >= MAX_ATTEMPTS:
+            state = FAILED
+        else:
+            next_at = now + min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+            heapq.heappush(self.heap, (next_at, i))
+
+        self._write_entry(i, (offset, length, attempts, state, next_at))
+        if state != PENDING:
+            self.states[PENDING] -= 1
+            self.states[state] += 1
+
+        return state
+
+    # sends whatever is due through client (a Client.AsyncClient) and records
+    # how each went. returns how many were tried
+    async def tick(self, client, now=None):
+        taken = self.due(now)
+
+        async def attempt(i):
+            host, port, message = self.message(i)
+            result = await client.send(host, port, message)
+            self.record(i, result.code)
+
+        await asyncio.gather(*(attempt(i) for i in taken))
+
+        return len(taken)
+
+    # keeps ticking until nothing is pending, sleeping until the next message
+    # is due in between
+    async def drain(self, client):
+        while self.heap:
+            wait = self.next_due() - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            await self.tick(client)
+
+    def close(self):
+        os.close(self.journal)
+        os.close(self.index)
+
+    def _write_entry(self, i, entry):
+        os.pwrite(self.index, QUEUE_RECORD.pack(*entry), i * QUEUE_RECORD.size)
+        if self.fsync:
+            os.fsync(self.index)
+
+    def _read_index(self):
+        chunks = []
+        offset = 0
+        size = self.count * QUEUE_RECORD.size
+        while offset < size:
+            chunk = os.pread(self.index, size - offset, offset)
+            chunks.append(chunk)
+            offset += len(chunk)
+
+        return b''.join(chunks)
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+async def _run(queue):
+    from Client import AsyncClient
+
+    client = AsyncClient()
+    try:
+        await queue.drain(client)
+    finally:
+        await client.close()
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        print('usage: python outqueue.py <queue dir> [run|status]')
+        exit(1)
+    else:
+        queue = OutboundQueue(argv[1])
+        if len(argv) > 2 and argv[2] == 'run':
+            asyncio.run(_run(queue))
+
+        print(', '.join(f'{queue.states[state]} {name}' for state, name in enumerate(STATE_NAMES)))
+        queue.close()
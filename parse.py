@@ -2,74 +2,298 @@
 # onyen: erzh
 # PID: 730294463
 
+import re
+from array import array
+from collections import namedtuple, OrderedDict
+from itertools import islice
+
+# what a parse hands back, a tuple so it can't be changed after the fact and
+# can be passed between sessions freely
+# status is 0 on success and any non-zero value on failure, cmd is the command
+# code (-1 when the line isn't any known command), bad_token and remainder say
+# where a failed parse went wrong, path and domain are pulled out of a valid
+# MAIL FROM/RCPT TO (path and domain) or HELO/EHLO (domain only), '' otherwise
+# size and last are the chunk size and LAST flag of a valid BDAT, -1 and False
+# for everything else
+ParseResult = namedtuple('ParseResult', ['status', 'cmd', 'bad_token', 'remainder', 'path', 'domain', 'size', 'last'],
+    defaults=(-1, False))
+
+_INVALID_CHARS = frozenset({' ', '\t', '\n', '<', '>', '(', ')', '[', ']', '\\', '.', ',', ';', ':', '@', '"'})
+
+# the grammar below compiled into one anchored regex per command
+# <string> is a run of anything outside _INVALID_CHARS
+_STRING = r'[^ \t\n<>()\[\]\\.,;:@"]+'
+_DOMAIN = rf'{_STRING}(?:\.{_STRING})*'
+_PATH = rf'<(?P<path>{_STRING}@(?P<domain>{_DOMAIN}))>'
+
+# keyed on the four letter command verb,
+# each entry is (cmd code, regex accepting exactly the valid lines)
+# only the text up to and including the <CRLF> is looked at, like the descent parser
+_FAST_PATHS = {
+    'MAIL': (0, re.compile(rf'MAIL[ \t]+FROM:[ \t]*{_PATH}[ \t]*\n')),
+    'RCPT': (1, re.compile(rf'RCPT[ \t]+TO:[ \t]*{_PATH}[ \t]*\n')),
+    'DATA': (2, re.compile(r'DATA[ \t]*\n')),
+    'HELO': (3, re.compile(rf'HELO[ \t]+(?P<domain>{_DOMAIN})[ \t]*\n')),
+    'QUIT': (4, re.compile(r'QUIT[ \t]*\n')),
+    'RSET': (5, re.compile(r'RSET[ \t]*\n')),
+    'EHLO': (6, re.compile(rf'EHLO[ \t]+(?P<domain>{_DOMAIN})[ \t]*\n')),
+    'BDAT': (7, re.compile(r'BDAT[ \t]+(?P<size>[0-9]+)(?:[ \t]+(?P<last>LAST))?[ \t]*\n'))
+}
+
+# default number of lines a PathCache remembers
+PATH_CACHE_SIZE = 4096
+# longest line a PathCache will hold on to, the RFC 5321 command line limit
+PATH_CACHE_LINE = 512
+
+# bounded LRU of MAIL FROM/RCPT TO lines -> ParseResult, so the same few
+# senders and recipients are only ever validated once while they stay hot
+# the key is the raw line the path came in on rather than the path alone,
+# since finding the path in a line costs as much as checking it. results are
+# immutable, so one cached result is handed to every caller
+# only lines that parsed are kept, and the parser never offers one longer
+# than PATH_CACHE_LINE, so a client sending junk can't fill it with big
+# entries
+class PathCache():
+    def __init__(self, size=PATH_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    # returns the cached result for line, calling parse(line) on a miss
+    def lookup(self, line, parse):
+        try:
+            result = self.entries[line]
+        except KeyError:
+            self.misses += 1
+
+            result = parse(line)
+            if result.status != 0:
+                return result
+
+            self.entries[line] = result
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+            return result
+
+        self.hits += 1
+        self.entries.move_to_end(line)
+
+        return result
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+# error classes reported by parse_many, the same split the servers make
+# between a 500 and a 501 reply
+ERR_NONE = 0
+ERR_CMD = 1 # command unrecognized
+ERR_PARAM = 2 # syntax error in parameters or arguments
+
+# lines parse_many takes from its input at a time
+BATCH_SIZE = 4096
+
+# one chunk of parse_many output, every field is an array with one entry per
+# input line. path_start/path_end are offsets of the path into the line, -1
+# when the line has no path or didn't parse
+ParseBatch = namedtuple('ParseBatch', ['cmd', 'status', 'error', 'path_start', 'path_end'])
+
+def _new_batch():
+    return ParseBatch(array('b'), array('b'), array('B'), array('l'), array('l'))
+
+# holds no state between calls, so one parser can be shared by every session
 class CMDParser():
-    def __init__(self):
+    # fast=False skips the regex fast path and always runs the recursive
+    # descent, only really useful for checking the two against each other
+    # path_cache is an optional PathCache for MAIL FROM/RCPT TO lines
+    def __init__(self, fast=True, path_cache=None):
+        self.fast = fast
+        self.path_cache = path_cache
+
+    # returns a ParseResult for one command line
+    def parse(self, inputstr):
+        if self.path_cache is not None and inputstr[:1] in ('M', 'R') and len(inputstr) <= PATH_CACHE_LINE:
+            return self.path_cache.lookup(inputstr, self._parse)
+
+        return self._parse(inputstr)
+
+    def _parse(self, inputstr):
+        # well formed commands are recognized in a single regex match, the
+        # descent only runs to work out what is wrong with a line
+        if self.fast and inputstr != '':
+            fast_path = _FAST_PATHS.get(inputstr[:4])
+            if fast_path is not None:
+                match = fast_path[1].match(inputstr)
+                if match is not None:
+                    groups = match.groupdict()
+                    if fast_path[0] == 7:
+                        return ParseResult(0, 7, '', '', '', '', int(groups['size']), groups['last'] is not None)
+
+                    return ParseResult(0, fast_path[0], '', '', groups.get('path', ''), groups.get('domain', ''))
+
+        return _DescentParser(inputstr).parse()
+
+    # parses any iterable of lines, taking chunk_size lines at a time and
+    # yielding a ParseBatch for each chunk
+    # nothing per line is allocated beyond the regex match, so this is the
+    # one to use for replaying whole transcripts
+    def parse_many(self, lines, chunk_size=BATCH_SIZE):
+        lines = iter(lines)
+        fast = self.fast
+
+        chunk = list(islice(lines, chunk_size))
+        while chunk:
+            batch = _new_batch()
+            cmds, statuses, errors, starts, ends = batch
+
+            for line in chunk:
+                match = None
+                if fast and line != '':
+                    fast_path = _FAST_PATHS.get(line[:4])
+                    if fast_path is not None:
+                        match = fast_path[1].match(line)
+
+                if match is not None:
+                    cmds.append(fast_path[0])
+                    statuses.append(0)
+                    errors.append(ERR_NONE)
+                    if 'path' in match.re.groupindex:
+                        start, end = match.span('path')
+                    else:
+                        start, end = -1, -1
+                else:
+                    descent = _DescentParser(line)
+                    descent.parse()
+
+                    cmds.append(descent.cmd)
+                    statuses.append(descent.status)
+                    if descent.status != 0:
+                        errors.append(ERR_CMD if descent.bad_token[-3:] == 'cmd' else ERR_PARAM)
+                        start, end = -1, -1
+                    else:
+                        errors.append(ERR_NONE)
+                        start, end = descent._path if descent.cmd < 2 else (-1, -1)
+
+                starts.append(start)
+                ends.append(end)
+
+            yield batch
+
+            chunk = list(islice(lines, chunk_size))
+
+# recursive descent over a single line, made fresh for every line it parses
+class _DescentParser():
+    def __init__(self, inputstr):
         self.status = 0 # any non-zero value represents parse failure
-        self.cmd = 0
+        self.cmd = -1
         self.bad_token = ''
         self.remainder = ''
 
-        self._stream = '' # holds remaining unparsed portion of the input string
-        self._invalid_chars = {' ', '\t', '\n', '<', '>', '(', ')', '[', ']', '\\', '.', ',', ';', ':', '@', '"'}
+        self._line = inputstr # the input string being parsed, never sliced while parsing
+        self._pos = 0 # index of the first unparsed character in self._line
 
-    def parse(self, inputstr):
-        self._start_parse(inputstr)
+        # where the path and domain sit in self._line, only meaningful on success
+        self._path = (0, 0)
+        self._domain = (0, 0)
 
+        # chunk size and LAST flag of a BDAT
+        self._size = -1
+        self._last = False
+
+    def parse(self):
         try:
-            if self._stream[0] == "M":
+            first = self._line[0]
+            if first == "M":
                 self.cmd = 0
                 self._parse_mail_from_cmd()
-            elif self._stream[0] == "R":
+            elif first == "R" and self._line[1:2] == "S":
+                self.cmd = 5
+                self._parse_rset_cmd()
+            elif first == "R":
                 self.cmd = 1
                 self._parse_rcpt_to_cmd()
-            elif self._stream[0] == "D":
+            elif first == "D":
                 self.cmd = 2
                 self._parse_data_cmd()
-            elif self._stream[0] == "H":
+            elif first == "H":
                 self.cmd = 3
                 self._parse_hello_cmd()
-            elif self._stream[0] == "Q":
+            elif first == "E":
+                self.cmd = 6
+                self._parse_ehlo_cmd()
+            elif first == "Q":
                 self.cmd = 4
                 self._parse_quit_cmd()
+            elif first == "B":
+                self.cmd = 7
+                self._parse_bdat_cmd()
+            else:
+                # doesn't even start like a command
+                self._fail_parse("unknown-cmd")
         except IndexError:
             self._fail_parse("empty-cmd")
-            return
+
+        if self.status != 0:
+            return ParseResult(self.status, self.cmd, self.bad_token, self.remainder, '', '')
+
+        return ParseResult(0, self.cmd, '', '',
+            self._line[self._path[0]:self._path[1]], self._line[self._domain[0]:self._domain[1]],
+            self._size, self._last)
 
     # ###### private helper functions ######
 
-    def _start_parse(self, inputstr):
-        self._stream = inputstr
-        self.bad_token = ''
-        self.status = 0
-    
     def _parse_hello_cmd(self):
         # <hello-cmd> --> HELO<whitespace><domain><nullspace><CRLF>
         try:
-            assert self._stream[:4] == 'HELO'
+            assert self._line.startswith('HELO', self._pos)
             self._shift(4)
 
             self._parse_whitespace()
 
+            start = self._pos
             self._parse_domain()
+            self._domain = (start, self._pos)
 
             self._parse_nullspace()
 
             # handles <CRLF> prod
-            assert self._stream[0] == '\n'
+            assert self._line[self._pos] == '\n'
         except (AssertionError, IndexError):
             self._fail_parse('hello-cmd')
             return
 
+    def _parse_ehlo_cmd(self):
+        # <ehlo-cmd> --> EHLO<whitespace><domain><nullspace><CRLF>
+        try:
+            assert self._line.startswith('EHLO', self._pos)
+            self._shift(4)
+
+            self._parse_whitespace()
+
+            start = self._pos
+            self._parse_domain()
+            self._domain = (start, self._pos)
+
+            self._parse_nullspace()
+
+            assert self._line[self._pos] == '\n'
+        except (AssertionError, IndexError):
+            self._fail_parse('ehlo-cmd')
+            return
+
     def _parse_mail_from_cmd(self):
         # parses a mail from command
         # <mail-from-cmd> --> MAIL<whitespace>FROM:<nullspace><reverse-path><nullspace><CRLF>
         try:
-            assert self._stream[:4] == 'MAIL'
+            assert self._line.startswith('MAIL', self._pos)
             self._shift(4)
 
             self._parse_whitespace()
 
-            assert self._stream[:5] == 'FROM:'
+            assert self._line.startswith('FROM:', self._pos)
             self._shift(5)
 
             self._parse_nullspace()
@@ -79,7 +303,7 @@ class CMDParser():
             self._parse_nullspace()
 
             # handles <CRLF> prod
-            assert self._stream[0] == '\n'
+            assert self._line[self._pos] == '\n'
         except (AssertionError, IndexError):
             self._fail_parse('mail-from-cmd')
             return
@@ -89,12 +313,12 @@ class CMDParser():
         # <rcpt-to-cmd> --> RCPT<whitespace>TO:<nullspace><forward-path><nullspace><CRLF>
 
         try:
-            assert self._stream[:4] == 'RCPT'
+            assert self._line.startswith('RCPT', self._pos)
             self._shift(4)
 
             self._parse_whitespace()
 
-            assert self._stream[:3] == 'TO:'
+            assert self._line.startswith('TO:', self._pos)
             self._shift(3)
 
             self._parse_nullspace()
@@ -103,7 +327,7 @@ class CMDParser():
 
             self._parse_nullspace()
 
-            assert self._stream[0] == '\n'
+            assert self._line[self._pos] == '\n'
         except (AssertionError, IndexError):
             self._fail_parse('rcpt-to-cmd')
             return
@@ -113,12 +337,12 @@ class CMDParser():
         # does not deal with the data that follows
         # <data-cmd> --> DATA<nullspace><CRLF>
         try:
-            assert self._stream[:4] == 'DATA'
+            assert self._line.startswith('DATA', self._pos)
             self._shift(4)
 
             self._parse_nullspace()
 
-            assert self._stream[0] == '\n'
+            assert self._line[self._pos] == '\n'
         except (AssertionError, IndexError):
             self._fail_parse('data-cmd')
             return
@@ -126,25 +350,68 @@ class CMDParser():
     def _parse_quit_cmd(self):
         # <quit-cmd> --> QUIT<nullspace><CRLF>
         try:
-            assert self._stream[:4] == 'QUIT'
+            assert self._line.startswith('QUIT', self._pos)
             self._shift(4)
 
             self._parse_nullspace()
 
-            assert self._stream[0] == '\n'
+            assert self._line[self._pos] == '\n'
         except (AssertionError, IndexError):
             self._fail_parse('quit-cmd')
             return
 
+    def _parse_rset_cmd(self):
+        # <rset-cmd> --> RSET<nullspace><CRLF>
+        try:
+            assert self._line.startswith('RSET', self._pos)
+            self._shift(4)
+
+            self._parse_nullspace()
+
+            assert self._line[self._pos] == '\n'
+        except (AssertionError, IndexError):
+            self._fail_parse('rset-cmd')
+            return
+
+    def _parse_bdat_cmd(self):
+        # <bdat-cmd> --> BDAT<whitespace><chunk-size>(<null>|<whitespace>LAST)<nullspace><CRLF>
+        # <chunk-size> --> <digit>|<digit><chunk-size>
+        try:
+            assert self._line.startswith('BDAT', self._pos)
+            self._shift(4)
+
+            self._parse_whitespace()
+
+            start = self._pos
+            while '0' <= self._line[self._pos] <= '9':
+                self._shift()
+            assert self._pos > start
+            self._size = int(self._line[start:self._pos])
+
+            end = self._pos
+            self._parse_nullspace()
+
+            if self._pos > end and self._line.startswith('LAST', self._pos):
+                self._shift(4)
+                self._last = True
+
+                self._parse_nullspace()
+
+            assert self._line[self._pos] == '\n'
+        except (AssertionError, IndexError):
+            self._fail_parse('bdat-cmd')
+            return
+
     def _parse_whitespace(self): # handles checking for <SP> as well
         # <whitespace> --> <SP>(<null>|<whitespace>)
+        line = self._line
         try:
-            assert self._stream[0] == ' ' or self._stream[0] == '\t'
-            self._shift()
+            assert line[self._pos] == ' ' or line[self._pos] == '\t'
+            self._pos += 1
 
             # iteratively check for recursing <whitespace> rule
-            while self._stream[0] == ' ' or self._stream[0] == '\t':
-                self._shift()
+            while line[self._pos] == ' ' or line[self._pos] == '\t':
+                self._pos += 1
         except (AssertionError, IndexError):
             self._fail_parse('whitespace-cmd')
             return
@@ -152,7 +419,7 @@ class CMDParser():
     def _parse_nullspace(self):
         # <nullspace> --> <null>|<whitespace>
         # iteratively check for recursing <whitespace> rule
-        if self._stream[0] == ' ' or self._stream[0] == '\t':
+        if self._line[self._pos] == ' ' or self._line[self._pos] == '\t':
             self._parse_whitespace()
 
     def _parse_path(self):
@@ -160,12 +427,14 @@ class CMDParser():
         # both <reverse-path> and <forward-path> prod rules seem like aliases for
         # <path> so this handles both rules
         try:
-            assert self._stream[0] == '<'
+            assert self._line[self._pos] == '<'
             self._shift()
 
+            start = self._pos
             self._parse_mailbox()
+            self._path = (start, self._pos)
 
-            assert self._stream[0] == '>'
+            assert self._line[self._pos] == '>'
             self._shift()
         except (AssertionError, IndexError):
             self._fail_parse('path')
@@ -176,10 +445,12 @@ class CMDParser():
         try:
             self._parse_string()
 
-            assert self._stream[0] == '@'
+            assert self._line[self._pos] == '@'
             self._shift()
 
+            start = self._pos
             self._parse_domain()
+            self._domain = (start, self._pos)
         except (AssertionError, IndexError):
             self._fail_parse('mailbox')
             return
@@ -187,38 +458,38 @@ class CMDParser():
     def _parse_string(self):
         # <string> --> <char>(<null>|<string>)
         # <local-part> production rule seems to just be an alias for <string> so this handles both
+        line = self._line
+        invalid = _INVALID_CHARS
         try:
-            assert self._stream[0] not in self._invalid_chars
-            self._shift()
+            assert line[self._pos] not in invalid
+            self._pos += 1
 
-            while self._stream[0] not in self._invalid_chars:
-                self._shift()
+            while line[self._pos] not in invalid:
+                self._pos += 1
         except (AssertionError, IndexError):
             self._fail_parse('string')
             return
 
     def _parse_domain(self):
         # <domain> --> <element>(<null>|.<domain>)
+        # the right recursion on .<domain> is unrolled into a loop, one pass per label
         # TODO which is it? parse string or element? the grammar is contradictory
         #self._parse_element()
         self._parse_string()
 
-        try:
-            if self._stream[0] == '.':
-                self._shift()
-                self._parse_domain()
-        except IndexError:
-            pass
+        while self._pos < len(self._line) and self._line[self._pos] == '.':
+            self._pos += 1
+            self._parse_string()
 
     def _parse_element(self):
         # <element> --> <letter>(<null>|<let-dig-str>)
         # substituted in <name> prod and left factored
 
         try:
-            assert self._stream[0].isalpha()
-            self._shift()
+            assert self._line[self._pos].isalpha()
+            self._pos += 1
 
-            if len(self._stream) != 0 and self._stream[0].isalnum():
+            if self._pos < len(self._line) and self._line[self._pos].isalnum():
                 self._parse_let_dig_str()
         except (AssertionError, IndexError):
             self._fail_parse('element')
@@ -227,11 +498,11 @@ class CMDParser():
     def _parse_let_dig_str(self):
         # <let-dig-str> --> (<letter>|<digit>)(<null>|<let-dig-str>)
         try:
-            assert self._stream[0].isalnum()
-            self._shift()
+            assert self._line[self._pos].isalnum()
+            self._pos += 1
 
-            while self._stream[0].isalnum():
-                self._shift()
+            while self._line[self._pos].isalnum():
+                self._pos += 1
         except (AssertionError, IndexError):
             self._fail_parse('element')
             return
@@ -239,27 +510,40 @@ class CMDParser():
     def _fail_parse(self, badtoken):
         if self.bad_token == '':
             self.bad_token = badtoken
-            self.remainder = self._stream
+            self.remainder = self._line[self._pos:]
         self.status = -1
     
-    # removes the first n characters of the input string
+    # moves past the next n characters of the input string
     def _shift(self, n=1):
-        self._stream = self._stream[n:]
+        self._pos += n
+
+# reply printed for each error class
+REPLIES = {
+    ERR_NONE:'250 OK',
+    ERR_CMD:'500 Syntax error: command unrecognized',
+    ERR_PARAM:'501 Syntax error in parameters or arguments'
+}
+# size of the buffer output is collected in before it is written out
+OUTBUF = 1 << 16
 
 if __name__ == "__main__":
     parser = CMDParser()
 
-    with open(0) as stdin:
-        print('debug')
-        for usrinput in stdin:
-            # echo the user input but remove the extra newline if present
-            print(usrinput[:-1] if usrinput[-1] == '\n' else usrinput)
-            parser.parse(usrinput)
+    with open(0) as stdin, open(1, 'w', buffering=OUTBUF, closefd=False) as stdout:
+        stdout.write('debug\n')
 
-            if parser.status == 0:
-                print('250 OK')
-            else:
-                if parser.bad_token[-3:] == 'cmd':
-                    print('500 Syntax error: command unrecognized')
-                else:
-                    print('501 Syntax error in parameters or arguments')
+        # lines are read and parsed a chunk at a time and each chunk's output
+        # goes out in one write
+        chunk = list(islice(stdin, BATCH_SIZE))
+        while chunk:
+            for batch in parser.parse_many(chunk, len(chunk)):
+                out = []
+                for usrinput, err in zip(chunk, batch.error):
+                    # echo the user input but remove the extra newline if present
+                    out.append(usrinput[:-1] if usrinput[-1] == '\n' else usrinput)
+                    out.append(REPLIES[err])
+                out.append('')
+
+                stdout.write('\n'.join(out))
+
+            chunk = list(islice(stdin, BATCH_SIZE))